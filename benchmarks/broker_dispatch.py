@@ -0,0 +1,64 @@
+"""Measure the broker's per-request scheduling cost as the worker count grows.
+
+Workers are registered directly through the broker's message handlers and
+frames to workers are discarded, so the cost is dominated by the
+scheduling structures.
+
+    python benchmarks/broker_dispatch.py --requests 100000
+"""
+from time import perf_counter, time
+
+import click
+
+from presence.rpc import READY, REPLY
+from presence.rpc.broker import Broker
+
+SERVICE = b'Bench'
+
+
+class NullBroker(Broker):
+    def _send_to_worker(self, worker, command, option=None, message=[]):
+        # Heartbeats are re-armed from last_sent, left alone they would
+        # fall due again straight away and the scheduler would never finish
+        worker.last_sent = time()
+
+
+def run(workers, requests):
+    broker = NullBroker('inproc://bench-dispatch-{}'.format(workers))
+
+    addresses = [b'worker-%d' % i for i in range(workers)]
+    for address in addresses:
+        broker._handle_worker(address, [READY, SERVICE])
+
+    # One outstanding request at a time: each dispatch takes the oldest
+    # waiting worker and each reply puts it back at the end of the queue
+    start = perf_counter()
+    for i in range(requests):
+        broker._handle_client(
+            b'client', [SERVICE, b'id', b'2500', b'', b'payload']
+        )
+        address = addresses[i % workers]
+        broker._handle_worker(
+            address, [REPLY, b'1', b'', b'client', b'', b'id', b'', b'reply']
+        )
+        broker._scheduler.run()
+    end = perf_counter()
+
+    return (end - start) / requests
+
+
+@click.command()
+@click.option('--requests', default=100000)
+@click.option(
+    '--workers', default='10,100,1000,10000', help='Comma separated counts'
+)
+def main(requests, workers):
+    print('{:>10} {:>16}'.format('workers', 'us/request'))
+
+    for count in [int(w) for w in workers.split(',')]:
+        cost = run(count, requests)
+        print('{:>10} {:>16.2f}'.format(count, cost * 1e6))
+
+
+if __name__ == '__main__':
+    main()
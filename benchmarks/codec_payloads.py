@@ -0,0 +1,68 @@
+"""Compare encode/decode cost and frame size of the available wire codecs.
+
+The payloads mirror what a Store client and worker exchange: single
+add_dhcp calls and their replies, a batch of calls, a stats reply and a
+large snapshot, which is sent as an out-of-band frame.
+
+    python benchmarks/codec_payloads.py --repeat 100000
+"""
+from timeit import timeit
+
+import click
+
+from presence.rpc.codecs import codecs
+
+CALL = (
+    b'Store', 'add_dhcp', ('00:11:22:33:44:55', '192.168.1.1', 'localhost'),
+    {}
+)
+
+PAYLOADS = [
+    ('call', CALL),
+    ('reply', True),
+    ('error', AttributeError('Remote Store instance has no attribute \'x\'')),
+    ('batch', (b'Store', [CALL[1:]] * 100)),
+    ('snapshot', (b'Store', 'restore', (b'\0' * (1 << 20), ), {})),
+    (
+        'stats', {
+            'memory': {
+                'resident': 31457280,
+                'virtual': 268435456,
+            },
+            'cpu': {
+                'user': 12.5,
+                'system': 3.25,
+                'percent': 4.0,
+            },
+        }
+    ),
+]
+
+
+@click.command()
+@click.option('--repeat', default=100000)
+def main(repeat):
+    print(
+        '{:>10} {:>8} {:>12} {:>12} {:>8} {:>6}'.format(
+            'codec', 'payload', 'encode ns', 'decode ns', 'bytes', 'frames'
+        )
+    )
+
+    for codec in codecs.values():
+        for name, payload in PAYLOADS:
+            frames = codec.encode(payload)
+            size = sum(memoryview(frame).nbytes for frame in frames)
+
+            encode = timeit(lambda: codec.encode(payload), number=repeat)
+            decode = timeit(lambda: codec.decode(frames), number=repeat)
+
+            print(
+                '{:>10} {:>8} {:>12.0f} {:>12.0f} {:>8} {:>6}'.format(
+                    codec.name.decode(), name, encode / repeat * 1e9,
+                    decode / repeat * 1e9, size, len(frames)
+                )
+            )
+
+
+if __name__ == '__main__':
+    main()
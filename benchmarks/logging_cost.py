@@ -0,0 +1,88 @@
+"""Measure what logging a message costs the sender in each logging mode.
+
+Each message is logged the way the broker, workers and clients log the
+frames they send and receive. Output goes to /dev/null so the cost is
+building, rendering and writing the event rather than the terminal.
+With background the rendering and writing happen on the listener
+thread, which is stopped, and so drained, before the clock is read.
+
+    python benchmarks/logging_cost.py --messages 100000
+"""
+import logging
+import os
+import sys
+from time import perf_counter
+
+import click
+import structlog
+
+import presence.log
+
+MESSAGE = [
+    b'\x00k\x8bEg', b'', b'MDPW01', b'\x02', b'client', b'',
+    b'0123456789abcdef', b'2500', b'msgpack', b'Store', b'add_dhcp',
+    b'\x93\xb100:11:22:33:44:55\xab192.168.1.1\xa9localhost'
+]
+
+# (name, level, renderer, background, sample rate, guarded)
+MODES = [
+    ('disabled', logging.INFO, 'console', False, 1.0, False),
+    ('disabled, guarded', logging.INFO, 'console', False, 1.0, True),
+    ('console', logging.DEBUG, 'console', False, 1.0, True),
+    ('json', logging.DEBUG, 'json', False, 1.0, True),
+    ('json, background', logging.DEBUG, 'json', True, 1.0, True),
+    ('json, 1% sampled', logging.DEBUG, 'json', False, 0.01, True),
+]
+
+
+def run(messages, level, renderer, background, sample_rate, guarded):
+    presence.log.configure(level, renderer, background, sample_rate)
+
+    log = structlog.getLogger('bench')
+
+    start = perf_counter()
+    if guarded:
+        for _ in range(messages):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Sending to broker', message=MESSAGE)
+    else:
+        for _ in range(messages):
+            log.debug('Sending to broker', message=MESSAGE)
+    sent = perf_counter()
+
+    # Reconfiguring stops the listener once it has written the backlog
+    presence.log.configure(logging.INFO)
+    end = perf_counter()
+
+    return (sent - start) / messages, (end - start) / messages
+
+
+@click.command()
+@click.option('--messages', default=100000)
+def main(messages):
+    # Handlers write to the stderr they find when they are created
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+
+    try:
+        results = [(mode[0], run(messages, *mode[1:])) for mode in MODES]
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+    print(
+        '{:<20} {:>16} {:>16}'.format(
+            'mode', 'us/msg (caller)', 'us/msg (total)'
+        )
+    )
+
+    for name, (caller, total) in results:
+        print(
+            '{:<20} {:>16.2f} {:>16.2f}'.format(
+                name, caller * 1e6, total * 1e6
+            )
+        )
+
+
+if __name__ == '__main__':
+    main()
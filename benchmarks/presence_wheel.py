@@ -0,0 +1,73 @@
+"""Measure the per-tick cost of departure detection on a simulated clock.
+
+Devices are first seen spread over one departure timeout, then each tick a
+fraction of them is seen again and the tracker advances one tick. The
+cost of a full scan over every device is shown for comparison.
+
+    python benchmarks/presence_wheel.py --devices 100000
+"""
+import logging
+import random
+from time import perf_counter
+
+import click
+
+import presence.log
+from presence.tasks.tracker import PresenceTracker
+
+
+@click.command()
+@click.option('--devices', default=100000)
+@click.option('--timeout', default=300.0, help='Departure timeout (s)')
+@click.option('--ticks', default=600)
+@click.option('--resight', default=0.01, help='Fraction seen per tick')
+def main(devices, timeout, ticks, resight):
+    # As the CLI runs by default
+    presence.log.configure(logging.INFO)
+
+    random.seed(0)
+
+    now = 0.0
+    tracker = PresenceTracker(timeout, 1.0, now)
+    macs = ['dev-{}'.format(i) for i in range(devices)]
+
+    for mac in macs:
+        tracker.seen(mac, random.uniform(now, now + timeout))
+    now += timeout
+
+    per_tick = max(1, int(devices * resight))
+    tick_times = []
+    departures = 0
+
+    for _ in range(ticks):
+        now += 1.0
+
+        for mac in random.sample(macs, per_tick):
+            tracker.seen(mac, now)
+
+        start = perf_counter()
+        departures += len(tracker.tick(now))
+        tick_times.append(perf_counter() - start)
+
+    start = perf_counter()
+    cutoff = now - timeout
+    # Devices gone for a second timeout have been dropped
+    sum(
+        1 for device in map(tracker.get, macs)
+        if device is not None and device.last_seen < cutoff
+    )
+    scan = perf_counter() - start
+
+    tick_times.sort()
+    mean = sum(tick_times) / ticks
+    p99 = tick_times[int(0.99 * ticks)]
+
+    print('devices         {:>10}'.format(devices))
+    print('departures      {:>10}'.format(departures))
+    print('tick mean       {:>10.1f} us'.format(1e6 * mean))
+    print('tick p99        {:>10.1f} us'.format(1e6 * p99))
+    print('full scan       {:>10.1f} us'.format(1e6 * scan))
+
+
+if __name__ == '__main__':
+    main()
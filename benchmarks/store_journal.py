@@ -0,0 +1,68 @@
+"""Measure Store write throughput with the journal and its recovery time.
+
+Writes are committed in groups the way the background committer would,
+then a snapshot is taken, a tail of updates is logged after it and the
+store is recovered from the directory.
+
+    python benchmarks/store_journal.py --leases 500000 --tail 50000
+"""
+import shutil
+import tempfile
+from time import perf_counter
+
+import click
+
+from presence.tasks.store import Store
+
+
+def mac(i):
+    return '02:00:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+        (i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff
+    )
+
+
+def write(store, start, count, group):
+    for i in range(start, start + count):
+        store.add_dhcp(mac(i), '10.0.0.{}'.format(i & 0xff), 'host')
+
+        if i % group == 0:
+            store._journal.commit()
+
+    store._journal.commit()
+
+
+@click.command()
+@click.option('--leases', default=500000)
+@click.option('--tail', default=50000)
+@click.option('--group', default=1000, help='Writes per fsync')
+def main(leases, tail, group):
+    path = tempfile.mkdtemp(prefix='presence-bench-')
+
+    try:
+        store = Store(path)
+
+        start = perf_counter()
+        write(store, 0, leases, group)
+        elapsed = perf_counter() - start
+        print('write     {:>12.0f} leases/s'.format(leases / elapsed))
+
+        start = perf_counter()
+        store._journal.snapshot()
+        print('snapshot  {:>12.2f} s'.format(perf_counter() - start))
+
+        write(store, leases, tail, group)
+        store._journal.close()
+
+        start = perf_counter()
+        recovered = Store(path)
+        print(
+            'recover   {:>12.2f} s for {} leases'.
+            format(perf_counter() - start, recovered.count())
+        )
+        recovered._journal.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
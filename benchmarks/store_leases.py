@@ -0,0 +1,91 @@
+"""Measure Store insert throughput and query latency for a large lease table.
+
+    python benchmarks/store_leases.py --leases 500000
+"""
+import logging
+from time import perf_counter, time
+
+import click
+
+import presence.log
+from presence.tasks.store import Store
+
+
+def mac(i):
+    return '02:00:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+        (i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff
+    )
+
+
+def ip(i):
+    return '10.{}.{}.{}'.format((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+
+
+def timed(func, args):
+    start = perf_counter()
+    for arg in args:
+        func(arg)
+    return (perf_counter() - start) / len(args)
+
+
+@click.command()
+@click.option('--leases', default=500000)
+@click.option('--queries', default=100000)
+def main(leases, queries):
+    # As the CLI runs by default
+    presence.log.configure(logging.INFO)
+
+    store = Store()
+
+    # Leases are spread over the last hour, oldest first
+    now = time()
+    start = perf_counter()
+    for i in range(leases):
+        seen = now - 3600 + 3600.0 * i / leases
+        store.add_dhcp(mac(i), ip(i), 'host-{}'.format(i % 1000), seen)
+    elapsed = perf_counter() - start
+    print('insert        {:>12.0f} leases/s'.format(leases / elapsed))
+
+    update_start = time()
+    for i in range(leases):
+        store.add_dhcp(mac(i), ip(i), 'host-{}'.format(i % 1000))
+    update_end = time()
+    print(
+        'update        {:>12.0f} leases/s'.
+        format(leases / (update_end - update_start))
+    )
+
+    keys = range(0, leases, max(1, leases // queries))
+    macs = [mac(i) for i in keys]
+    ips = [ip(i) for i in keys]
+    hostnames = ['host-{}'.format(i % 1000) for i in keys]
+
+    print(
+        'lookup_mac    {:>12.2f} us'.
+        format(timed(store.lookup_mac, macs) * 1e6)
+    )
+    print('lookup_ip     {:>12.2f} us'.format(timed(store.lookup_ip, ips) * 1e6))
+    print(
+        'lookup_host   {:>12.2f} us'.
+        format(timed(store.lookup_hostname, hostnames[:1000]) * 1e6)
+    )
+
+    # Only the freshest 1% of leases were seen within the window
+    window = time() - update_end + 0.01 * (update_end - update_start)
+    start = perf_counter()
+    recent = store.recently_seen(window)
+    print(
+        'recently_seen {:>12.2f} ms for {} leases'.
+        format((perf_counter() - start) * 1e3, len(recent))
+    )
+
+    start = perf_counter()
+    expired = store.expire(0)
+    print(
+        'expire        {:>12.2f} ms for {} leases'.
+        format((perf_counter() - start) * 1e3, expired)
+    )
+
+
+if __name__ == '__main__':
+    main()
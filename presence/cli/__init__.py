@@ -1,5 +1,4 @@
 import errno
-import logging
 import os
 import sys
 
@@ -10,6 +9,7 @@ from click_didyoumean import DYMGroup
 from click_repl import repl
 from prompt_toolkit.history import FileHistory
 
+import presence.log
 from presence import __app_name__, __banner__, config
 from presence.cli.utils import handle_log_level
 
@@ -28,11 +28,14 @@ log = structlog.getLogger()
     help='Either CRITICAL, ERROR, WARNING, INFO or DEBUG'
 )
 def cli(log_level, config_file=None):
-    logging.getLogger().setLevel(log_level)
-
     if config_file:
         config.read(config_file)
 
+    presence.log.configure(
+        log_level, config['log_format'], config['log_background'],
+        config['log_sample_rate']
+    )
+
     config_dir = os.path.join(click.get_app_dir(__app_name__))
 
     log.debug('Creating application directory "{}"'.format(config_dir))
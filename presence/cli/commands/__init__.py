@@ -1 +1,2 @@
 import presence.cli.commands.run
+import presence.cli.commands.bench
@@ -0,0 +1,255 @@
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+from time import perf_counter, time
+
+import click
+import gevent
+import structlog
+from gevent import sleep
+
+from presence.cli import cli
+from presence.rpc import AsyncClient, Broker, Embedded, RPCException, ServiceClient, Worker
+from presence.rpc.metrics import Histogram
+
+log = structlog.getLogger()
+
+TRANSPORTS = ('inproc', 'ipc', 'tcp')
+
+
+class Echo(object):
+    """The service being benchmarked, it replies with its argument"""
+
+    def echo(self, payload):
+        return payload
+
+
+def _endpoints(transport, tmp_dir):
+    if transport == 'inproc':
+        endpoint = 'inproc://presence-bench'
+        return endpoint, endpoint
+
+    if transport == 'ipc':
+        endpoint = 'ipc://{}'.format(os.path.join(tmp_dir, 'broker'))
+        return endpoint, endpoint
+
+    # Let the OS pick a free port
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    endpoint = 'tcp://127.0.0.1:{}'.format(port)
+    return endpoint, endpoint
+
+
+def _run_broker(bind):
+    Broker(bind).start()
+
+
+def _run_worker(connect, concurrency):
+    Worker(connect, Echo(), concurrency=concurrency).start()
+
+
+def _wait_for_workers(connect, workers, context=None):
+    service_client = ServiceClient(connect, context=context)
+
+    while True:
+        stats = service_client.stats()
+
+        if stats is not None and len(stats['waiting_workers']) >= workers:
+            return
+
+        sleep(0.1)
+
+
+def _run_client(
+    connect, workers, concurrency, payload, duration, context=None
+):
+    # Measure with every worker serving
+    _wait_for_workers(connect, workers, context)
+
+    client = AsyncClient(connect, Echo, context=context)
+    client.echo(b'').get()
+
+    payload = os.urandom(payload)
+    histogram = Histogram()
+    errors = []
+    deadline = time() + duration
+
+    def run_calls():
+        while time() < deadline:
+            start = perf_counter()
+
+            try:
+                client.echo(payload).get()
+            except RPCException as exc:
+                errors.append(exc)
+            else:
+                histogram.record(perf_counter() - start)
+
+    start = perf_counter()
+    gevent.joinall([gevent.spawn(run_calls) for _ in range(concurrency)])
+    elapsed = perf_counter() - start
+
+    client.close()
+
+    return {
+        'histogram': histogram.as_dict(),
+        'errors': len(errors),
+        'elapsed': elapsed,
+    }
+
+
+def _client_process(results, *args):
+    results.put(_run_client(*args))
+
+
+def _run_embedded(bind, connect, clients, workers, options):
+    # inproc only works within one context, so everything shares this
+    # process and its context as greenlets
+    embedded = Embedded(bind)
+
+    for _ in range(workers):
+        embedded.add_worker(
+            Echo(), concurrency=options['worker_concurrency']
+        )
+
+    runs = [
+        gevent.spawn(
+            _run_client, embedded.endpoint, workers, options['concurrency'],
+            options['payload'], options['duration'], embedded.context
+        ) for _ in range(clients)
+    ]
+    gevent.joinall(runs, raise_error=True)
+    embedded.stop()
+
+    return [run.get() for run in runs]
+
+
+def _run_processes(bind, connect, clients, workers, options):
+    mp = multiprocessing.get_context('fork')
+    results = mp.Queue()
+
+    servers = [mp.Process(target=_run_broker, args=(bind, ))]
+    servers += [
+        mp.Process(
+            target=_run_worker,
+            args=(connect, options['worker_concurrency'])
+        ) for _ in range(workers)
+    ]
+
+    runs = [
+        mp.Process(
+            target=_client_process,
+            args=(
+                results, connect, workers, options['concurrency'],
+                options['payload'], options['duration']
+            )
+        ) for _ in range(clients)
+    ]
+
+    for process in servers + runs:
+        process.start()
+
+    try:
+        return [
+            results.get(timeout=options['duration'] + 60) for _ in runs
+        ]
+    finally:
+        for process in servers + runs:
+            process.terminate()
+            process.join()
+
+
+@cli.command()
+@click.option('--clients', default=1, help='Number of client processes')
+@click.option('--workers', default=1, help='Number of worker processes')
+@click.option(
+    '-c',
+    '--concurrency',
+    default=1,
+    help='Number of calls each client keeps in flight'
+)
+@click.option(
+    '--worker-concurrency',
+    default=1,
+    help='Number of requests each worker runs at once'
+)
+@click.option('-s', '--payload', default=64, help='Payload size in bytes')
+@click.option('-d', '--duration', default=10.0, help='Seconds to run for')
+@click.option(
+    '-t',
+    '--transport',
+    type=click.Choice(TRANSPORTS),
+    default='tcp',
+    help='inproc runs everything as greenlets in this process'
+)
+@click.option(
+    '-o',
+    '--output',
+    type=click.Path(dir_okay=False, writable=True),
+    help='Write the results as JSON to this file'
+)
+def bench(
+    clients, workers, concurrency, worker_concurrency, payload, duration,
+    transport, output
+):
+    """Benchmark the broker, workers and clients on this host"""
+    options = {
+        'concurrency': concurrency,
+        'worker_concurrency': worker_concurrency,
+        'payload': payload,
+        'duration': duration,
+    }
+
+    tmp_dir = tempfile.mkdtemp(prefix='presence-bench-')
+
+    try:
+        bind, connect = _endpoints(transport, tmp_dir)
+
+        log.info(
+            'Benchmark starting...',
+            transport=transport,
+            clients=clients,
+            workers=workers
+        )
+
+        if transport == 'inproc':
+            results = _run_embedded(bind, connect, clients, workers, options)
+        else:
+            results = _run_processes(bind, connect, clients, workers, options)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    histogram = Histogram()
+    for result in results:
+        histogram.merge(Histogram.from_dict(result['histogram']))
+
+    elapsed = max(result['elapsed'] for result in results)
+
+    report = {
+        'transport': transport,
+        'clients': clients,
+        'workers': workers,
+        'errors': sum(result['errors'] for result in results),
+        'throughput': histogram.count / elapsed,
+        'latency': histogram.summary(),
+    }
+    report.update(options)
+
+    click.echo('requests     {:>12}'.format(histogram.count))
+    click.echo('errors       {:>12}'.format(report['errors']))
+    click.echo('throughput   {:>12.0f} calls/s'.format(report['throughput']))
+
+    for name in ('mean', 'p50', 'p99', 'p999', 'max'):
+        click.echo(
+            '{:<12} {:>12.1f} us'.format(name, 1e6 * report['latency'][name])
+        )
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
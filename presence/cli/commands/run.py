@@ -1,15 +1,56 @@
 import click
 import structlog
+from gevent import sleep
 
 from click_didyoumean import DYMGroup
 
 from presence import config
 from presence.cli import cli
-from presence.rpc import Broker, Client, Worker, ServiceClient
+from presence.rpc import AsyncClient, Broker, Client, Embedded, Worker, ServiceClient
+from presence.rpc.events import Subscriber
 from presence.tasks.store import Store
 
 log = structlog.getLogger()
 
+bind_option = click.option(
+    '--bind',
+    multiple=True,
+    help='Endpoint for the broker to listen on, e.g. tcp://*:5000, '
+    'ipc:///tmp/presence. May be repeated'
+)
+
+connect_option = click.option(
+    '--connect', help='Endpoint of the broker, e.g. ipc:///tmp/presence'
+)
+
+events_option = click.option(
+    '--events',
+    multiple=True,
+    help='Endpoint to publish broker events on, e.g. tcp://*:5001. '
+    'May be repeated'
+)
+
+
+def get_bind(bind):
+    if bind:
+        return list(bind)
+
+    return ['tcp://*:{}'.format(config['port'])]
+
+
+def get_connect(connect):
+    if connect:
+        return connect
+
+    return 'tcp://{}:{}'.format(config['broker'], config['port'])
+
+
+def get_events(events):
+    if events:
+        return list(events)
+
+    return ['tcp://*:{}'.format(config['event_port'])]
+
 
 @cli.group(cls=DYMGroup)
 def run():
@@ -17,66 +58,265 @@ def run():
 
 
 @run.command()
-def broker():
+@bind_option
+@events_option
+def broker(bind, events):
     """Run the broker"""
-    port = config['port']
-    bind = 'tcp://*:{}'.format(port)
+    bind = get_bind(bind)
 
     log.info('Broker starting...', bind=bind)
 
-    broker = Broker(bind)
+    broker = Broker(bind, events=get_events(events))
     broker.start()
 
 
 @run.command()
+@bind_option
+@events_option
+@click.option(
+    '-c',
+    '--concurrency',
+    default=1,
+    help='Number of requests to run at once'
+)
+@click.option(
+    '-d',
+    '--data-dir',
+    type=click.Path(file_okay=False),
+    help='Directory to keep the store\'s log and snapshots in'
+)
+def embedded(bind, events, concurrency, data_dir):
+    """Run the broker and the store in one process"""
+    bind = get_bind(bind)
+
+    log.info('Embedded broker starting...', bind=bind)
+
+    embedded = Embedded(binds=bind, events=get_events(events))
+    embedded.add_worker(
+        Store(data_dir or config['store_path']), concurrency=concurrency
+    )
+
+    try:
+        embedded.join()
+    except KeyboardInterrupt:
+        embedded.stop()
+
+
+@run.command()
+@connect_option
 @click.option('-i', '--identifier', default='')
-def store(identifier):
+@click.option(
+    '-c',
+    '--concurrency',
+    default=1,
+    help='Number of requests to run at once'
+)
+@click.option(
+    '-p',
+    '--prefetch',
+    type=int,
+    help='Number of requests to queue beyond the concurrency'
+)
+@click.option(
+    '-d',
+    '--data-dir',
+    type=click.Path(file_okay=False),
+    help='Directory to keep the store\'s log and snapshots in'
+)
+def store(connect, identifier, concurrency, prefetch, data_dir):
     """Run the store"""
-    broker = config['broker']
-    port = config['port']
-    connect = 'tcp://{}:{}'.format(broker, port)
+    connect = get_connect(connect)
 
     log.info('Running Store...', connect=connect)
 
-    worker = Worker(connect, Store(), service_suffix=identifier)
+    worker = Worker(
+        connect,
+        Store(data_dir or config['store_path']),
+        service_suffix=identifier,
+        concurrency=concurrency,
+        prefetch=prefetch
+    )
     worker.start()
 
 
 @run.command()
+@connect_option
 @click.option('-i', '--identifier', default='')
-def test(identifier):
+@click.option(
+    '-e',
+    '--embedded',
+    is_flag=True,
+    help='Run a broker and store in this process and call them over inproc'
+)
+@click.option(
+    '-p',
+    '--pipeline',
+    is_flag=True,
+    help='Keep all the calls in flight at once'
+)
+@click.option(
+    '-b', '--batch', is_flag=True, help='Send the calls as a single batch'
+)
+def test(connect, identifier, embedded, pipeline, batch):
     """Test the store"""
-    broker = config['broker']
-    port = config['port']
-    connect = 'tcp://{}:{}'.format(broker, port)
+    context = None
+
+    if embedded:
+        embedded = Embedded()
+        embedded.add_worker(Store(), service_suffix=identifier)
+
+        connect = embedded.endpoint
+        context = embedded.context
+    else:
+        connect = get_connect(connect)
 
     log.info('Testing Store...', connect=connect)
 
-    store = Client(connect, Store, service_suffix=identifier)
     from time import time
-    start = time()
-    for _ in range(1000):
-        store.add_dhcp('00:11:22:33:44:55', '192.168.1.1', 'localhost')
-    end = time()
+    if batch:
+        store = Client(
+            connect, Store, service_suffix=identifier, context=context
+        )
+        start = time()
+        with store.batch() as calls:
+            for _ in range(1000):
+                calls.add_dhcp('00:11:22:33:44:55', '192.168.1.1', 'localhost')
+        end = time()
+    elif pipeline:
+        store = AsyncClient(
+            connect, Store, service_suffix=identifier, context=context
+        )
+        start = time()
+        results = [
+            store.add_dhcp('00:11:22:33:44:55', '192.168.1.1', 'localhost')
+            for _ in range(1000)
+        ]
+        for result in results:
+            result.get()
+        end = time()
+        store.close()
+    else:
+        store = Client(
+            connect, Store, service_suffix=identifier, context=context
+        )
+        start = time()
+        for _ in range(1000):
+            store.add_dhcp('00:11:22:33:44:55', '192.168.1.1', 'localhost')
+        end = time()
     log.info('1000 finished', time=(end - start))
 
+    if embedded:
+        embedded.stop()
+
 
 @run.command()
-def stats():
+@connect_option
+def stats(connect):
     """Get the broker stats"""
     from pprint import pprint as pp
 
-    broker = config['broker']
-    port = config['port']
-    connect = 'tcp://{}:{}'.format(broker, port)
+    connect = get_connect(connect)
 
     log.info('Getting stats...', connect=connect)
 
     service_client = ServiceClient(connect)
     stats = service_client.stats()
 
+    # Includes the usage each worker last reported, so the workers
+    # themselves are not asked
     pp(stats)
 
-    for worker in stats['workers']:
-        print(worker)
-        pp(service_client.worker_stats(worker))
+
+@run.command()
+@connect_option
+def metrics(connect):
+    """Print the broker metrics in Prometheus text format"""
+    connect = get_connect(connect)
+
+    service_client = ServiceClient(connect)
+    text = service_client.metrics()
+
+    if text is None:
+        log.error('No reply from broker', connect=connect)
+    else:
+        click.echo(text, nl=False)
+
+
+@run.command()
+@connect_option
+@click.argument('worker')
+@click.option('-d', '--duration', default=10.0, help='Seconds to profile for')
+@click.option(
+    '-i', '--interval', type=float, help='Milliseconds between samples'
+)
+@click.option(
+    '-o',
+    '--output',
+    type=click.Path(dir_okay=False, writable=True),
+    help='Write the collapsed stacks to this file, e.g. for flamegraph.pl'
+)
+def profile(connect, worker, duration, interval, output):
+    """Profile a worker, as listed by run stats, for a while"""
+    connect = get_connect(connect)
+    worker = worker.encode()
+
+    service_client = ServiceClient(connect)
+
+    if service_client.start_profile(worker, interval) is None:
+        log.error('No such worker', worker=worker)
+        return
+
+    log.info('Profiling...', worker=worker, duration=duration)
+    sleep(duration)
+
+    profile = service_client.stop_profile(worker)
+
+    if profile is None:
+        log.error('No profile from worker', worker=worker)
+        return
+
+    click.echo(
+        '{:<24} {:>10} {:>8} {:>12} {:>12}'.format(
+            'method', 'calls', 'errors', 'mean ms', 'max ms'
+        )
+    )
+
+    for name, timings in sorted(profile['methods'].items()):
+        click.echo(
+            '{:<24} {:>10} {:>8} {:>12.3f} {:>12.3f}'.format(
+                name, timings['calls'], timings['errors'],
+                1e3 * timings['mean_time'], 1e3 * timings['max_time']
+            )
+        )
+
+    if output:
+        with open(output, 'w') as f:
+            f.write(profile['stacks'])
+
+        log.info('Stacks written', samples=profile['samples'], output=output)
+
+
+@run.command()
+@click.option(
+    '--connect', help='Event endpoint of the broker, e.g. tcp://host:5001'
+)
+@click.option(
+    '-t',
+    '--topic',
+    multiple=True,
+    help='Only show events whose topic starts with this. May be repeated'
+)
+def events(connect, topic):
+    """Follow the broker's event stream"""
+    if not connect:
+        connect = 'tcp://{}:{}'.format(config['broker'], config['event_port'])
+
+    log.info('Following events...', connect=connect)
+
+    subscriber = Subscriber(connect, [t.encode() for t in topic])
+
+    try:
+        for topic, data in subscriber:
+            click.echo('{} {}'.format(topic.decode(), data))
+    except KeyboardInterrupt:
+        subscriber.close()
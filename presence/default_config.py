@@ -1,12 +1,39 @@
 default_config = {
     'broker': '127.0.0.1',
     'port': 5000,
+    'broker_batch_size': 256,
+    'client_batch_size': 1000,
+    'client_cache_size': 1000,
+    'client_methods_ttl': 10000,
     'client_retries': 3,
     'client_timeout': 2500,
+    'codecs': [b'pickle'],
     'control_service': b'icc',
+    'departure_timeout': 300000,
+    'event_interval': 1000,
+    'event_port': 5001,
     'heartbeat_count': 3,
     'heartbeat_interval': 2500,
     'heartbeat_liveness': 3,
+    'log_background': False,
+    'log_format': 'console',
+    'log_sample_rate': 1.0,
+    'metrics_interval': 10000,
+    'presence_tick': 1000,
+    'profile_interval': 5,
     'reconnect_interval': 2500,
+    'reply_cache_size': 10000,
+    'reply_cache_ttl': 10000,
+    'service_max_queue': 10000,
+    'store_commit_interval': 50,
+    'store_path': None,
+    'store_snapshot_interval': 600000,
+    'store_snapshot_records': 1000000,
+    'store_sync_commit': False,
+    'trace_path': 'presence-trace.json',
+    'trace_sample_rate': 0.0,
+    'usage_interval': 10000,
+    'worker_prefetch': 1,
     'worker_timeout': 2500,
+    'zero_copy_threshold': 65536,
 }
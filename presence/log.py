@@ -1,53 +1,198 @@
+import atexit
 import logging.config
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+from random import random
+
 import structlog
 
-timestamper = structlog.processors.TimeStamper(fmt="%Y-%m-%d %H:%M:%S.%f")
-pre_chain = [
-    structlog.stdlib.add_log_level,
-    timestamper,
-]
-
-logging.config.dictConfig(
-    {
-        "version": 1,
-        "disable_existing_loggers": False,
-        "formatters": {
-            "plain": {
-                "()": structlog.stdlib.ProcessorFormatter,
-                "processor": structlog.dev.ConsoleRenderer(colors=False),
-                "foreign_pre_chain": pre_chain,
-            },
-            "colored": {
-                "()": structlog.stdlib.ProcessorFormatter,
-                "processor": structlog.dev.ConsoleRenderer(colors=True),
-                "foreign_pre_chain": pre_chain,
-            },
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+RENDERERS = ('console', 'json')
+
+
+class DebugSampler(object):
+    """Drops all but a fraction of debug events.
+
+    The broker, workers and clients log every message they send and
+    receive at debug, sampling keeps a picture of the traffic without
+    paying for all of it.
+    """
+
+    def __init__(self, rate=1.0):
+        self.rate = rate
+
+    def __call__(self, logger, method_name, event_dict):
+        if method_name == 'debug' and random() >= self.rate:
+            raise structlog.DropEvent
+
+        return event_dict
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    # The stock handler formats the record before queueing it, which would
+    # render the event on the caller's thread. The listener is in this
+    # process so the record can be handed over as it is
+    def prepare(self, record):
+        return record
+
+
+def add_timestamp(logger, method_name, event_dict):
+    """Stamps the event with when its record was created.
+
+    The event may be rendered on the listener thread some time after it
+    was logged, so the time is taken from the record rather than the clock.
+    """
+    created = event_dict['_record'].created
+    event_dict['timestamp'] = datetime.fromtimestamp(
+        created, timezone.utc
+    ).strftime(TIMESTAMP_FORMAT)
+
+    return event_dict
+
+
+def detach(logger, method_name, event_dict):
+    """Keeps what the event needs from the caller before it is handed on.
+
+    The exception being handled is only known on the caller's thread. In
+    background, lists are copied as the caller goes on to pop frames from
+    the messages it has logged before the listener renders them.
+    """
+    if event_dict.get('exc_info') is True:
+        event_dict['exc_info'] = sys.exc_info()
+
+    if _listener is not None:
+        for key, value in event_dict.items():
+            if isinstance(value, list):
+                event_dict[key] = list(value)
+
+    return event_dict
+
+
+sampler = DebugSampler()
+
+_listener = None
+
+
+def _processors(renderer):
+    # Everything but filtering runs in the handler, which in background is
+    # on the listener thread
+    return [
+        add_timestamp,
+        structlog.stdlib.add_logger_name,
+        structlog.stdlib.ProcessorFormatter.remove_processors_meta,
+        structlog.stdlib.add_log_level,
+        structlog.stdlib.PositionalArgumentsFormatter(),
+        structlog.processors.format_exc_info,
+        renderer,
+    ]
+
+
+def _formatters():
+    return {
+        "plain": {
+            "()": structlog.stdlib.ProcessorFormatter,
+            "processors": _processors(
+                structlog.dev.ConsoleRenderer(colors=False)
+            ),
         },
-        "handlers": {
-            "default": {
-                "level": "DEBUG",
-                "class": "logging.StreamHandler",
-                "formatter": "colored",
-            },
+        "colored": {
+            "()": structlog.stdlib.ProcessorFormatter,
+            "processors": _processors(
+                structlog.dev.ConsoleRenderer(colors=True)
+            ),
         },
-        "loggers": {
-            "": {
-                "handlers": ["default"],
-                "level": "DEBUG",
-                "propagate": True,
+        "json": {
+            "()": structlog.stdlib.ProcessorFormatter,
+            # Message frames are bytes
+            "processors": _processors(
+                structlog.processors.JSONRenderer(default=repr)
+            ),
+        },
+    }
+
+
+def configure(
+    level=logging.DEBUG, renderer='console', background=False, sample_rate=1.0
+):
+    """Sets up the log handler.
+
+    renderer is either console or json. The caller only filters and
+    samples the event, the rest of the processors, rendering and writing
+    happen in the handler. With background, records are put on a queue
+    and the handler is run by a thread, though it still takes the GIL
+    from the event loop while it does. Debug events are kept with
+    probability sample_rate.
+    """
+    global _listener
+
+    assert renderer in RENDERERS
+
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+    formatter = 'json' if renderer == 'json' else 'colored'
+
+    logging.config.dictConfig(
+        {
+            "version": 1,
+            "disable_existing_loggers": False,
+            "formatters": _formatters(),
+            "handlers": {
+                "default": {
+                    "level": "DEBUG",
+                    "class": "logging.StreamHandler",
+                    "formatter": formatter,
+                },
             },
+            "loggers": {
+                "": {
+                    "handlers": ["default"],
+                    "level": level,
+                    "propagate": True,
+                },
+            }
         }
-    }
-)
+    )
+
+    sampler.rate = sample_rate
+
+    if background:
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+
+        for handler in handlers:
+            root.removeHandler(handler)
+
+        records = queue.Queue()
+        root.addHandler(_QueueHandler(records))
+
+        _listener = logging.handlers.QueueListener(
+            records, *handlers, respect_handler_level=True
+        )
+        _listener.start()
+
+
+def _stop_listener():
+    if _listener is not None:
+        _listener.stop()
+
+
+atexit.register(_stop_listener)
+
+configure()
 
 structlog.configure(
     processors=[
-        structlog.stdlib.add_logger_name,
-        structlog.stdlib.add_log_level,
-        structlog.stdlib.PositionalArgumentsFormatter(),
-        timestamper,
+        # Events below the logger's level go no further
+        structlog.stdlib.filter_by_level,
+        sampler,
+        # Needs the caller's stack
         structlog.processors.StackInfoRenderer(),
-        structlog.processors.format_exc_info,
+        detach,
         structlog.stdlib.ProcessorFormatter.wrap_for_formatter,
     ],
     context_class=dict,
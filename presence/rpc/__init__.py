@@ -1,6 +1,12 @@
+BATCH = b'batch'
+CALL = b'call'
 CLIENT = b'client'
+CODECS = b'codecs'
 DISCONNECT = b'disconnect'
 HEARTBEAT = b'heartbeat'
+METHODS = b'methods'
+METRICS = b'metrics'
+PROFILE = b'profile'
 READY = b'ready'
 REPLY = b'reply'
 REQUEST = b'request'
@@ -17,6 +23,16 @@ class TimeoutException(RPCException):
     pass
 
 
+class OverloadedException(RPCException):
+    pass
+
+
+class CodecException(RPCException):
+    pass
+
+
+from .decorators import cacheable, expose  # noqa
 from .broker import Broker  # noqa
 from .worker import Worker  # noqa
-from .client import Client, ServiceClient  # noqa
+from .client import AsyncClient, Client, ServiceClient  # noqa
+from .embedded import Embedded  # noqa
@@ -1,16 +1,28 @@
-import pickle
+import struct
 from binascii import hexlify
+from logging import DEBUG
+from collections import Counter, OrderedDict, deque
 from time import time
 
 import structlog
 import zmq.green as zmq
 
 from .. import config
-from . import CLIENT, DISCONNECT, HEARTBEAT, READY, REPLY, REQUEST, STATS, WORKER, WORKER_STATS
-from .utils import get_usage
+from . import CLIENT, CODECS, DISCONNECT, HEARTBEAT, METHODS, METRICS, PROFILE, READY, REPLY, REQUEST, STATS, WORKER, WORKER_STATS, OverloadedException
+from .codecs import PICKLE, choose_codec, codecs, get_codec
+from .events import BROKER_METRICS, QUEUE_DEPTH, WORKER_JOINED, WORKER_LEFT, Publisher
+from .metrics import ServiceMetrics, prometheus_text
+from .scheduler import Scheduler
+from .tracing import HOP
+from .utils import get_usage, recv_multipart, unpack_usage
 
 log = structlog.getLogger()
 
+# When a request arrived and when it was dispatched. Sent with the request
+# and handed back untouched with the reply, so the broker can time it
+# without keeping anything per request
+STAMP = struct.Struct('!dd')
+
 
 class Worker(object):
     def __init__(self, identity, address, lifetime):
@@ -18,35 +30,91 @@ class Worker(object):
         self.address = address
         self.service = None
         self.expiry = time() + 1e-3 * lifetime
+        # Number of further requests the worker has said it will accept.
+        # Granted in READY, spent on dispatch and returned with REPLY
+        self.credits = 1
+        # Requests dispatched that the worker has not yet replied to
+        self.in_flight = 0
+        self.requests = 0
+        # Anything sent to the worker tells it we are alive, a heartbeat is
+        # only needed once it has heard nothing for a heartbeat interval
+        self.last_sent = time()
+        self.heartbeat_timer = None
+        self.expiry_timer = None
+        # Codecs the worker said it understands in READY
+        self.codecs = {PICKLE}
+        # Latest usage the worker sent with a heartbeat and when it came
+        self.usage = None
+        self.usage_at = None
 
 
 class Service(object):
     def __init__(self, name):
         self.name = name
-        self.requests = []
-        self.waiting_workers = []
+        # (deadline, enqueued, message) triples, oldest first
+        self.requests = deque()
+        self.waiting_workers = OrderedDict()
+        # Codecs understood by every worker serving the service, None
+        # while it has none. Kept from how many workers understand each
+        # codec, so joins and leaves do not scan the workers
+        self.codecs = None
+        self.codec_counts = Counter()
+        self.workers = 0
+        # Pickled description of the methods served, as sent by the most
+        # recent worker to join
+        self.methods = None
+        self.metrics = ServiceMetrics()
+        # Queue depth last published as an event
+        self.published_depth = 0
 
 
 class Broker(object):
-    def __init__(self, bind):
+    def __init__(self, bind, context=None, events=None):
         self._heartbeat_count = config['heartbeat_count']
         self._heartbeat_interval = config['heartbeat_interval']
+        self._batch_size = config['broker_batch_size']
         self._control_service = config['control_service']
+        self._max_queue = config['service_max_queue']
+        self._metrics_interval = config['metrics_interval']
+        self._event_interval = config['event_interval']
 
         self._heartbeat_expiry = self._heartbeat_count * self._heartbeat_interval
-        self._heartbeat_at = time() + 1e-3 * self._heartbeat_interval
+
+        # Each worker has its own heartbeat and expiry timers, so a wakeup
+        # only costs the workers that are due rather than a scan of them all
+        self._scheduler = Scheduler()
+        self._heartbeats_suppressed = 0
+        self._scheduler.call_later(
+            1e-3 * self._metrics_interval, self._update_metrics
+        )
 
         self._workers = {}
-        self._waiting_workers = []
+        self._waiting_workers = {}
         self._services = {}
 
-        context = zmq.Context()
+        # inproc endpoints only reach sockets made from the same context
+        if context is None:
+            context = zmq.Context()
 
         self._sock = context.socket(zmq.ROUTER)
         self._sock.linger = 0
-        self._sock.bind(bind)
 
-        log.info('Broker listening', bind=bind)
+        # Any mix of tcp, ipc and inproc endpoints
+        if not isinstance(bind, list):
+            bind = [bind]
+
+        for endpoint in bind:
+            self._sock.bind(endpoint)
+
+            log.info('Broker listening', bind=endpoint)
+
+        # Events go out on their own PUB endpoints, if any are given
+        self._events = None
+        if events:
+            self._events = Publisher(context, events)
+            self._scheduler.call_later(
+                1e-3 * self._event_interval, self._publish_depths
+            )
 
         self._poller = zmq.Poller()
         self._poller.register(self._sock, zmq.POLLIN)
@@ -54,30 +122,42 @@ class Broker(object):
     def start(self):
         while True:
             try:
-                items = self._poller.poll(self._heartbeat_interval)
+                items = self._poller.poll(
+                    self._scheduler.timeout(self._heartbeat_interval)
+                )
             except KeyboardInterrupt:
                 break
 
             if items:
-                message = self._sock.recv_multipart()
+                self._recv_batch()
 
-                log.debug('Got a message', message=message)
+            self._scheduler.run()
 
-                sender = message.pop(0)
-                empty = message.pop(0)
-                assert empty == b''
+    def _recv_batch(self):
+        # Drain everything that is already queued on the socket, up to
+        # the batch size, so that timers are run once per wakeup rather
+        # than once per message
+        for _ in range(self._batch_size):
+            try:
+                message = recv_multipart(self._sock, zmq.NOBLOCK)
+            except zmq.Again:
+                break
+
+            if log.isEnabledFor(DEBUG):
+                log.debug('Got a message', message=message)
 
-                header = message.pop(0)
+            sender = message.pop(0)
+            empty = message.pop(0)
+            assert empty == b''
 
-                if header == CLIENT:
-                    self._handle_client(sender, message)
-                elif header == WORKER:
-                    self._handle_worker(sender, message)
-                else:
-                    log.error('Invalid message')
+            header = message.pop(0)
 
-            self._purge_workers()
-            self._send_heartbeats()
+            if header == CLIENT:
+                self._handle_client(sender, message)
+            elif header == WORKER:
+                self._handle_worker(sender, message)
+            else:
+                log.error('Invalid message')
 
     def _handle_worker(self, sender, message):
         assert len(message) >= 1
@@ -87,6 +167,10 @@ class Broker(object):
         worker_ready = hexlify(sender) in self._workers
         worker = self._get_worker(sender)
 
+        # Any frame from a known worker proves it is alive
+        if worker_ready:
+            self._refresh_expiry(worker)
+
         if command == READY:
             assert len(message) >= 1
 
@@ -95,83 +179,183 @@ class Broker(object):
             if worker_ready or service == self._control_service:
                 self._delete_worker(worker, True)
             else:
+                if message:
+                    worker.credits = max(1, int(message.pop(0)))
+
+                if message:
+                    worker.codecs = set(message.pop(0).split(b','))
+
                 worker.service = self._get_service(service)
+                self._update_codecs(worker.service, worker, 1)
+
+                if message:
+                    worker.service.methods = message
+
+                self._publish(
+                    WORKER_JOINED, {
+                        'worker': worker.identity,
+                        'service': worker.service.name,
+                    }
+                )
+
                 self._worker_is_waiting(worker)
         elif command == REPLY:
             if worker_ready:
+                # Only replies to requests return credit
+                returned = int(message.pop(0))
+                worker.credits += returned
+                worker.in_flight -= returned
+
+                # Replies to control commands are not stamped
+                stamp = message.pop(0)
+                if stamp:
+                    self._record_reply(worker.service, stamp)
+
                 client = message.pop(0)
                 empty = message.pop(0)
                 assert empty == b''
 
                 message = [client, b'', CLIENT, worker.service.name] + message
 
-                self._sock.send_multipart(message)
+                self._sock.send_multipart(message, copy=False)
                 self._worker_is_waiting(worker)
             else:
                 self._delete_worker(worker, True)
         elif command == HEARTBEAT:
-            if worker_ready:
-                worker.expiry = time() + 1e-3 * self._heartbeat_expiry
-            else:
+            if not worker_ready:
                 self._delete_worker(worker, True)
+            elif message:
+                worker.usage = unpack_usage(message.pop(0))
+                worker.usage_at = time()
         elif command == DISCONNECT:
             self._delete_worker(worker, False)
         else:
             log.error("Invalid message", message=message)
 
     def _handle_client(self, sender, message):
-        assert len(message) >= 2
+        assert len(message) >= 5
 
         service = message.pop(0)
 
+        # The client sends how long, in ms, it will wait for this attempt
+        now = time()
+        deadline = now + 1e-3 * int(message.pop(1))
+
         message = [sender, b''] + message
 
         if service == self._control_service:
             self._handle_control(service, message)
         else:
-            self._dispatch(self._get_service(service), message)
+            service = self._get_service(service)
+
+            self._drop_expired(service)
+
+            if len(service.requests) >= self._max_queue:
+                self._reject(service, message)
+            else:
+                service.metrics.requests += 1
+                self._dispatch(service, (deadline, now, message))
 
     def _handle_control(self, service, message):
-        assert len(message) >= 3
+        assert len(message) >= 6
 
         client = message.pop(0)
 
         empty = message.pop(0)
         assert empty == b''
 
+        request_id = message.pop(0)
+
+        # Control commands are not traced
+        message.pop(0)
+
         command = message.pop(0)
+        codec = get_codec(message.pop(0))
 
         # Command handling should pop params from message
-        # and, send a pickled response in reply... or set
+        # and, send an encoded response in reply... or set
         # reply to None to ignore message - you must be
         # sure that something will respond or the client
         # will timeout
-        reply = pickle.dumps(None)
+        reply = codec.encode(None)
 
         if command == STATS:
             stats = {}
 
             stats['workers'] = [name for name in self._workers.keys()]
             stats['waiting_workers'] = [
-                worker.identity for worker in self._waiting_workers
+                worker.identity for worker in self._waiting_workers.values()
             ]
+            stats['worker_requests'] = {
+                worker.identity: worker.requests
+                for worker in self._workers.values()
+            }
+            stats['worker_usage'] = {}
+            for worker in self._workers.values():
+                if worker.usage is not None:
+                    usage = dict(worker.usage, age=time() - worker.usage_at)
+                    stats['worker_usage'][worker.identity] = usage
             stats['services'] = {}
+            stats['metrics'] = {}
             for svc in self._services.values():
                 stats['services'][svc.name] = len(svc.requests)
+                stats['metrics'][svc.name] = svc.metrics.as_dict()
+            stats['heartbeats_suppressed'] = self._heartbeats_suppressed
+            stats['requests_expired'] = sum(
+                svc.metrics.expired for svc in self._services.values()
+            )
+            stats['requests_rejected'] = sum(
+                svc.metrics.rejected for svc in self._services.values()
+            )
             stats['usage'] = get_usage()
 
-            reply = pickle.dumps(stats)
+            reply = codec.encode(stats)
+        elif command == CODECS:
+            name = message.pop(0)
+            svc = self._services.get(name)
+
+            # None until a worker has joined, so the client does not
+            # settle on a codec the workers may not prefer
+            if svc is not None and svc.codecs is not None:
+                reply = codec.encode(choose_codec(message, svc.codecs))
+        elif command == METRICS:
+            reply = codec.encode(self._prometheus_text())
+        elif command == METHODS:
+            svc = self._services.get(message.pop(0))
+
+            # Passed on as the worker pickled it
+            if svc is not None and svc.methods is not None:
+                codec = codecs[PICKLE]
+                reply = svc.methods
         elif command == WORKER_STATS:
             identity = message.pop(0)
             worker = self._workers.get(identity)
 
             if worker:
-                self._send_to_worker(worker, STATS, message=client)
+                self._send_to_worker(
+                    worker,
+                    STATS,
+                    message=[client, b'', request_id, codec.name]
+                )
+                reply = None
+        elif command == PROFILE:
+            identity = message.pop(0)
+            worker = self._workers.get(identity)
+
+            # The worker is passed the action and its arguments
+            if worker:
+                self._send_to_worker(
+                    worker,
+                    PROFILE,
+                    message=[client, b'', request_id, codec.name] + message
+                )
                 reply = None
 
         if reply:
-            message = [client, b'', CLIENT, service, reply]
-            self._sock.send_multipart(message)
+            message = [
+                client, b'', CLIENT, service, request_id, b'', codec.name
+            ] + reply
+            self._sock.send_multipart(message, copy=False)
 
     def _get_worker(self, address):
         assert address is not None
@@ -184,48 +368,104 @@ class Broker(object):
             worker = Worker(identity, address, self._heartbeat_expiry)
             self._workers[identity] = worker
 
+            worker.heartbeat_timer = self._scheduler.call_later(
+                1e-3 * self._heartbeat_interval, self._send_heartbeat, worker
+            )
+            worker.expiry_timer = self._scheduler.call_at(
+                worker.expiry, self._expire_worker, worker
+            )
+
             log.info('New worker', worker=identity)
 
         return worker
 
-    def _delete_worker(self, worker, disconnect):
+    def _delete_worker(self, worker, disconnect, reason='left'):
         assert worker is not None
 
         if disconnect:
             log.info('Disconnecting worker', worker=worker.identity)
             self._send_to_worker(worker, DISCONNECT)
+            reason = 'disconnected'
 
         if worker.service is not None:
-            worker.service.waiting_workers.remove(worker)
+            worker.service.waiting_workers.pop(worker.identity, None)
+
+            self._publish(
+                WORKER_LEFT, {
+                    'worker': worker.identity,
+                    'service': worker.service.name,
+                    'reason': reason,
+                }
+            )
 
+        self._scheduler.cancel(worker.heartbeat_timer)
+        self._scheduler.cancel(worker.expiry_timer)
+
+        self._waiting_workers.pop(worker.identity, None)
         self._workers.pop(worker.identity)
 
+        if worker.service is not None:
+            self._update_codecs(worker.service, worker, -1)
+
+    def _update_codecs(self, service, worker, change):
+        service.workers += change
+
+        for name in worker.codecs:
+            service.codec_counts[name] += change
+
+        if service.workers:
+            service.codecs = {
+                name
+                for name, count in service.codec_counts.items()
+                if count == service.workers
+            }
+        else:
+            service.codecs = None
+
     def _worker_is_waiting(self, worker):
-        if worker not in self._waiting_workers:
-            self._waiting_workers.append(worker)
+        if worker.credits > 0:
+            self._waiting_workers[worker.identity] = worker
+            worker.service.waiting_workers[worker.identity] = worker
 
-        if worker not in worker.service.waiting_workers:
-            worker.service.waiting_workers.append(worker)
+        self._dispatch(worker.service, None)
 
+    def _refresh_expiry(self, worker):
+        # The expiry timer is left alone, when it fires it is simply set
+        # again for the new expiry
         worker.expiry = time() + 1e-3 * self._heartbeat_expiry
 
-        self._dispatch(worker.service, None)
+    def _expire_worker(self, worker):
+        now = time()
 
-    def _purge_workers(self):
-        self._waiting_workers = sorted(
-            self._waiting_workers, key=lambda w: w.expiry
-        )
+        # Only idle workers are expired, a busy one may be stuck in a long
+        # call and is checked again a full expiry period later. With spare
+        # credit a busy worker is still waiting, so requests are counted
+        if worker.expiry < now and worker.in_flight == 0:
+            log.info('Expiring worker', worker=worker.identity)
 
-        while self._waiting_workers:
-            worker = self._waiting_workers[0]
+            self._delete_worker(worker, False, 'expired')
+        else:
+            when = worker.expiry
+            if when < now:
+                when = now + 1e-3 * self._heartbeat_expiry
 
-            if worker.expiry < time():
-                log.info('Expiring worker', worker=worker.identity)
+            worker.expiry_timer = self._scheduler.call_at(
+                when, self._expire_worker, worker
+            )
 
-                self._delete_worker(worker, False)
-                self._waiting_workers.pop(0)
-            else:
-                break
+    def _send_heartbeat(self, worker):
+        now = time()
+        when = worker.last_sent + 1e-3 * self._heartbeat_interval
+
+        if now >= when:
+            self._send_to_worker(worker, HEARTBEAT)
+            when = worker.last_sent + 1e-3 * self._heartbeat_interval
+        else:
+            self._heartbeats_suppressed += 1
+
+        worker.heartbeat_timer = self._scheduler.call_at(
+            when, self._send_heartbeat, worker
+        )
 
     def _send_to_worker(self, worker, command, option=None, message=[]):
         if not isinstance(message, list):
@@ -236,9 +476,11 @@ class Broker(object):
 
         message = [worker.address, b'', WORKER, command] + message
 
-        log.debug('Sending to worker', message=message)
+        if log.isEnabledFor(DEBUG):
+            log.debug('Sending to worker', message=message)
 
-        self._sock.send_multipart(message)
+        self._sock.send_multipart(message, copy=False)
+        worker.last_sent = time()
 
     def _get_service(self, name):
         assert name is not None
@@ -253,24 +495,143 @@ class Broker(object):
 
         return service
 
-    def _dispatch(self, service, message):
+    def _dispatch(self, service, request):
         assert service is not None
 
-        if message is not None:
-            service.requests.append(message)
+        if request is not None:
+            service.requests.append(request)
 
-        self._purge_workers()
+        now = time()
 
         while service.waiting_workers and service.requests:
-            message = service.requests.pop(0)
-            worker = service.waiting_workers.pop(0)
+            deadline, enqueued, message = service.requests.popleft()
+
+            # The worker is sent the time left rather than the deadline so
+            # that clocks need not agree
+            ttl = int(1e3 * (deadline - now))
+
+            if ttl <= 0:
+                service.metrics.expired += 1
+                continue
+
+            service.metrics.queue_wait.record(now - enqueued)
+
+            _, worker = service.waiting_workers.popitem(last=False)
+
+            worker.credits -= 1
+            worker.in_flight += 1
+            worker.requests += 1
+
+            # Workers with credit left go to the back of the queue so that
+            # requests are spread round robin
+            if worker.credits > 0:
+                service.waiting_workers[worker.identity] = worker
+            else:
+                self._waiting_workers.pop(worker.identity)
+
+            message[3:3] = [str(ttl).encode(), STAMP.pack(enqueued, now)]
+
+            # Sampled requests carry a trace frame, the broker's part of it
+            # is when the request was queued and dispatched
+            if message[5]:
+                message[5] += HOP.pack(enqueued, now)
 
-            self._waiting_workers.remove(worker)
             self._send_to_worker(worker, REQUEST, message=message)
 
-    def _send_heartbeats(self):
-        if time() > self._heartbeat_at:
-            for worker in self._waiting_workers:
-                self._send_to_worker(worker, HEARTBEAT)
+    def _drop_expired(self, service):
+        # Clients mostly use the same timeout, so expired requests gather
+        # at the head of the queue
+        now = time()
+        requests = service.requests
+
+        while requests and requests[0][0] < now:
+            requests.popleft()
+            service.metrics.expired += 1
+
+    def _reject(self, service, message):
+        client, _, request_id = message[:3]
+
+        log.warn('Service overloaded', service=service.name)
+        service.metrics.rejected += 1
+
+        # Encoded with pickle, which every client understands, as the
+        # request is never decoded here
+        reply = codecs[PICKLE].encode(
+            OverloadedException(
+                'Service {} has {} requests queued'.format(
+                    service.name.decode(), len(service.requests)
+                )
+            )
+        )
+
+        message = [client, b'', CLIENT, service.name, request_id, b'', PICKLE]
+        self._sock.send_multipart(message + reply, copy=False)
+
+    def _record_reply(self, service, stamp):
+        enqueued, dispatched = STAMP.unpack(stamp)
+        now = time()
+
+        service.metrics.replies += 1
+        service.metrics.service_time.record(now - dispatched)
+        service.metrics.latency.record(now - enqueued)
+
+    def _update_metrics(self):
+        for service in self._services.values():
+            service.metrics.update_rate(1e-3 * self._metrics_interval)
+
+        if self._events is not None:
+            self._publish(
+                BROKER_METRICS, {
+                    'workers': len(self._workers),
+                    'waiting_workers': len(self._waiting_workers),
+                    'heartbeats_suppressed': self._heartbeats_suppressed,
+                    'services': {
+                        service.name: dict(
+                            service.metrics.as_dict(),
+                            depth=len(service.requests)
+                        )
+                        for service in self._services.values()
+                    },
+                }
+            )
+
+        self._scheduler.call_later(
+            1e-3 * self._metrics_interval, self._update_metrics
+        )
 
-            self._heartbeat_at = time() + 1e-3 * self._heartbeat_interval
+    def _prometheus_text(self):
+        services = {
+            service.name.decode(): (service.metrics, len(service.requests))
+            for service in self._services.values()
+        }
+        workers = {
+            (worker.service.name.decode(), worker.identity.decode()):
+            worker.requests
+            for worker in self._workers.values()
+            if worker.service is not None
+        }
+
+        return prometheus_text(services, workers)
+
+    def _publish(self, topic, data):
+        if self._events is not None:
+            self._events.publish(topic, data)
+
+    def _publish_depths(self):
+        # Depths are compared on a timer rather than published as they
+        # change, so the request path does no extra work
+        for service in self._services.values():
+            depth = len(service.requests)
+
+            if depth != service.published_depth:
+                service.published_depth = depth
+                self._publish(
+                    QUEUE_DEPTH, {
+                        'service': service.name,
+                        'depth': depth,
+                    }
+                )
+
+        self._scheduler.call_later(
+            1e-3 * self._event_interval, self._publish_depths
+        )
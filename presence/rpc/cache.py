@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from time import time
+
+
+class TTLCache(object):
+    """Bounded LRU mapping whose entries also expire ttl seconds after they
+    were stored, unless put is given a ttl of its own. Expired entries are
+    dropped when next looked up or when they reach the LRU end.
+    """
+
+    def __init__(self, size, ttl):
+        self._size = size
+        self._ttl = ttl
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            expiry, value = entry
+
+            if expiry > time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+                return value
+
+            del self._entries[key]
+
+        self.misses += 1
+
+        return default
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self._ttl
+
+        self._entries[key] = (time() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._size:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -1,16 +1,87 @@
-import pickle
-
+import os
+import struct
+from collections import deque
+from itertools import count
+from logging import DEBUG
+from time import time
+
+import gevent
 import structlog
 import zmq.green as zmq
+from gevent.event import AsyncResult
+from gevent.lock import Semaphore
 
 from .. import config
-from . import CLIENT, STATS, WORKER_STATS, TimeoutException
+from . import BATCH, CALL, CLIENT, CODECS, METHODS, METRICS, PROFILE, STATS, WORKER_STATS, CodecException, TimeoutException
+from .cache import TTLCache
+from .codecs import PICKLE, as_bytes, available_codecs, codecs, get_codec
+from .decorators import get_metadata
+from .tracing import Tracer
+from .utils import recv_multipart
 
 log = structlog.getLogger()
 
+_MISSING = object()
+
+# Stub classes keyed by (client class, wrapped class)
+_stubs = {}
+
+
+def _remote_method(name, ttl):
+    attr_name = name.encode()
+
+    if ttl is None:
+
+        def method(self, *args, **kwargs):
+            return self._remote_call(attr_name, args, kwargs)
+    else:
+
+        def method(self, *args, **kwargs):
+            return self._cached_call(attr_name, ttl, args, kwargs)
+
+    method.__name__ = name
+
+    return method
+
+
+def _stub_class(client_cls, wrapped_cls):
+    """Returns a subclass of client_cls with a remote method, or property
+    for non-callable attributes, for every public attribute of wrapped_cls.
+    Built once per pair so that calls skip __getattr__ altogether.
+    """
+    key = (client_cls, wrapped_cls)
+    stub = _stubs.get(key)
+
+    if stub is None:
+        namespace = {}
+
+        for name in dir(wrapped_cls):
+            # The client's own methods, e.g. batch, take precedence
+            if name.startswith('_') or hasattr(client_cls, name):
+                continue
+
+            attr = getattr(wrapped_cls, name)
+            method = _remote_method(name, get_metadata(attr).get('cacheable'))
+
+            namespace[name] = method if callable(attr) else property(method)
+
+        stub = type(
+            '{}{}'.format(wrapped_cls.__name__, client_cls.__name__),
+            (client_cls, ), namespace
+        )
+        _stubs[key] = stub
+
+    return stub
+
 
 class Client(object):
-    def __init__(self, broker, cls, service_suffix=''):
+    def __new__(klass, *args, **kwargs):
+        # The wrapped class may be passed by position or as cls
+        cls = args[1] if len(args) > 1 else kwargs['cls']
+
+        return super(Client, klass).__new__(_stub_class(klass, cls))
+
+    def __init__(self, broker, cls, service_suffix='', context=None):
         self._broker = broker
         self._wrapped_cls = cls
         self._service = bytes('{}{}'.format(cls.__name__, service_suffix), 'utf8')
@@ -18,13 +89,49 @@ class Client(object):
 
         self._retries = config['client_retries']
         self._timeout = config['client_timeout']
-
-        self._context = zmq.Context()
+        self._batch_size = config['client_batch_size']
+        self._control_service = config['control_service']
+
+        # Each attempt tells the broker how long we will wait for it, so
+        # the request can be dropped rather than served after we give up
+        self._ttl = str(self._timeout).encode()
+
+        # Results of calls marked cacheable, each entry with its own TTL
+        self._cache = TTLCache(config['client_cache_size'], 0)
+
+        # Control replies can use our favourite codec straight away, calls
+        # use whichever one the service's workers agree on, negotiated with
+        # the broker on first use
+        self._control_codec = get_codec(available_codecs()[0])
+        self._codec = None
+        # What the service's workers advertise, fetched along with the
+        # codec so that calls they would refuse fail without a round trip
+        self._methods = None
+        # A name missing from them fetches them again, in case the workers
+        # were upgraded, but no more than once every methods_ttl
+        self._methods_ttl = 1e-3 * config['client_methods_ttl']
+        self._methods_fetched = 0
+
+        self._request_prefix = os.urandom(8)
+        self._request_counter = count()
+
+        # A sample of requests carry a trace frame, their spans are
+        # written out when the reply arrives
+        self._tracer = Tracer(
+            config['trace_sample_rate'], config['trace_path']
+        )
+
+        self._context = context or zmq.Context()
         self._poller = zmq.Poller()
         self._sock = None
 
         self._connect_to_broker()
 
+    def _next_request_id(self):
+        return self._request_prefix + struct.pack(
+            '!Q', next(self._request_counter)
+        )
+
     def _connect_to_broker(self):
         log.info('Connecting to broker', broker=self._broker)
 
@@ -38,19 +145,28 @@ class Client(object):
         self._sock.connect(self._broker)
         self._poller.register(self._sock, zmq.POLLIN)
 
-    def _send(self, message):
+    def _send(self, message, service=None):
         if not isinstance(message, list):
             message = [message]
 
-        message = [CLIENT, self._service] + message
+        if service is None:
+            service = self._service
+
+        request_id = self._next_request_id()
+
+        trace = self._tracer.start()
+        span_name = self._span_name(service, message) if trace else None
 
-        log.debug('Sending to broker', message=message)
+        message = [CLIENT, service, request_id, self._ttl, trace] + message
+
+        if log.isEnabledFor(DEBUG):
+            log.debug('Sending to broker', message=message)
 
         reply = None
 
         retries = self._retries
         while retries > 0:
-            self._sock.send_multipart(message)
+            self._sock.send_multipart(message, copy=False)
 
             try:
                 items = self._poller.poll(self._timeout)
@@ -58,17 +174,25 @@ class Client(object):
                 break
 
             if items:
-                message = self._sock.recv_multipart()
+                message = recv_multipart(self._sock)
 
-                log.debug('Received reply', message=message)
+                if log.isEnabledFor(DEBUG):
+                    log.debug('Received reply', message=message)
 
-                assert len(message) >= 3
+                assert len(message) >= 5
 
                 header = message.pop(0)
                 assert header == CLIENT
 
-                service = message.pop(0)
-                assert self._ignore_service or service == self._service
+                reply_service = message.pop(0)
+                assert self._ignore_service or reply_service == service
+
+                reply_id = message.pop(0)
+                assert reply_id == request_id
+
+                trace = message.pop(0)
+                if trace:
+                    self._tracer.finish(trace, span_name)
 
                 reply = message
                 break
@@ -85,13 +209,59 @@ class Client(object):
         return reply
 
     def __getattr__(self, attr_name):
+        # Public attributes are found on the stub class, this is only
+        # reached for private ones and names the wrapped class lacks
+        self._check_attr(attr_name)
+
+        def remote_call(*args, **kwargs):
+            return self._remote_call(attr_name.encode(), args, kwargs)
+
+        if callable(getattr(self._wrapped_cls, attr_name)):
+            return remote_call
+        else:
+            return remote_call()
+
+    def _check_attr(self, attr_name):
         if not hasattr(self._wrapped_cls, attr_name):
             raise AttributeError(
                 'Remote {} instance has no attribute \'{}\''.
                 format(self._wrapped_cls, attr_name)
             )
 
-        def remote_call(*args, **kwargs):
+    def batch(self, calls=None):
+        if calls is None:
+            return Batch(self)
+
+        calls = list(calls)
+
+        results = []
+        for i in range(0, len(calls), self._batch_size):
+            results.extend(self._batch_call(calls[i:i + self._batch_size]))
+
+        return results
+
+    def _batch_call(self, calls):
+        if log.isEnabledFor(DEBUG):
+            log.debug(
+                'Calling remote batch', cls=self._service, calls=len(calls)
+            )
+
+        resp = self._send(self._encode_batch(calls))
+
+        if resp is None:
+            raise TimeoutException()
+
+        resp = self._decode_reply(resp)
+
+        # Errors for the request as a whole, e.g. the broker rejecting it,
+        # come back in place of the list of results
+        if isinstance(resp, Exception):
+            raise resp
+        else:
+            return resp
+
+    def _remote_call(self, attr_name, args, kwargs):
+        if log.isEnabledFor(DEBUG):
             log.debug(
                 'Calling remote procedure',
                 cls=self._service,
@@ -100,51 +270,434 @@ class Client(object):
                 kwargs=kwargs
             )
 
-            to_send = pickle.dumps((self._service, attr_name, args, kwargs))
-            resp = self._send(to_send)
+        resp = self._send(self._encode_call(attr_name, args, kwargs))
 
-            assert resp == None or len(resp) == 1
+        if resp is None:
+            raise TimeoutException()
 
-            if resp is not None:
-                resp = pickle.loads(resp[0])
+        resp = self._decode_reply(resp)
 
-                if isinstance(resp, Exception):
-                    raise resp
-                else:
-                    return resp
-            else:
-                raise TimeoutException()
-
-        if callable(getattr(self._wrapped_cls, attr_name)):
-            return remote_call
+        if isinstance(resp, Exception):
+            raise resp
         else:
-            return remote_call()
+            return resp
 
+    def _cached_call(self, attr_name, ttl, args, kwargs):
+        try:
+            key = (attr_name, args, frozenset(kwargs.items()))
+            value = self._cache.get(key, _MISSING)
+        except TypeError:
+            # Unhashable arguments cannot be cached
+            return self._remote_call(attr_name, args, kwargs)
 
-class ServiceClient(Client):
-    def __init__(self, broker):
-        super(ServiceClient, self).__init__(broker, type('None'))
+        if value is _MISSING:
+            value = self._remote_call(attr_name, args, kwargs)
+            self._store_cached(key, value, ttl)
 
-        self._service = b'icc'
-        self._ignore_service = True
+        return value
 
-    def stats(self):
-        return self._control_service(STATS)
+    def _store_cached(self, key, value, ttl):
+        self._cache.put(key, value, ttl)
 
-    def worker_stats(self, worker):
-        return self._control_service(WORKER_STATS, worker)
+    def _control(self, command, args=None):
+        resp = self._send(
+            self._encode_control(command, args), self._control_service
+        )
+
+        if resp is None:
+            return None
 
-    def _control_service(self, name, args=None):
-        message = [name]
+        return self._decode_reply(resp)
+
+    def _get_codec(self):
+        if self._codec is None:
+            name = self._control(CODECS, [self._service] + available_codecs())
+
+            # Stay on pickle, without remembering it, if the broker is away
+            # or no workers have joined yet
+            if name is None:
+                return codecs[PICKLE]
+
+            self._codec = get_codec(name)
+
+            log.info(
+                'Negotiated codec', cls=self._service, codec=self._codec.name
+            )
+
+            self._refresh_methods()
+
+        return self._codec
+
+    def _refresh_methods(self):
+        methods = self._control(METHODS, self._service)
+        self._methods_fetched = time()
+
+        if methods is not None:
+            self._methods = {
+                name.encode(): method
+                for name, method in methods.items()
+            }
+
+    def _encode_control(self, command, args=None):
+        message = [command, self._control_codec.name]
 
         if args:
             if not isinstance(args, list):
                 args = [args]
             message += args
 
-        resp = self._send(message)
+        return message
+
+    def _check_method(self, attr_name):
+        if self._methods is None:
+            return
+
+        # Workers may have been upgraded since the methods were fetched
+        if (
+            attr_name not in self._methods
+            and time() - self._methods_fetched >= self._methods_ttl
+        ):
+            self._refresh_methods()
 
-        if resp:
-            return pickle.loads(resp[0])
+        if attr_name not in self._methods:
+            raise AttributeError(
+                'Remote {} instance has no attribute \'{}\''.
+                format(self._service, attr_name.decode())
+            )
+
+    def _encode_call(self, attr_name, args, kwargs):
+        codec = self._get_codec()
+        self._check_method(attr_name)
+
+        # Only the arguments need encoding, names go as raw frames
+        return [CALL, codec.name, self._service, attr_name] + codec.encode(
+            (args, kwargs)
+        )
+
+    def _encode_batch(self, calls):
+        codec = self._get_codec()
+
+        # Calls are not checked here, the worker puts any error in that
+        # call's place in the results
+        return [BATCH, codec.name, self._service] + codec.encode(calls)
+
+    def _span_name(self, service, message):
+        name = service.decode()
+
+        if message[0] == CALL:
+            name += '.' + message[3].decode()
+
+        return name
+
+    def _decode_reply(self, resp):
+        assert len(resp) >= 2
+
+        # Buffers sent out of band arrive as memoryviews, callers get bytes
+        # whatever the size
+        reply = as_bytes(get_codec(resp[0]).decode(resp[1:]))
+
+        # The codec was negotiated before a worker that does not
+        # understand it joined, the next call negotiates again
+        if isinstance(reply, CodecException):
+            self._codec = None
+
+        return reply
+
+
+class Batch(object):
+    """Collects calls made on it and sends them as one request on exit.
+
+    Within the block calls return None; once it exits, results holds one
+    entry per call, with exceptions raised remotely in place of values.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.results = self._client.batch(self._calls)
+
+    def __getattr__(self, attr_name):
+        self._client._check_attr(attr_name)
+
+        def batched_call(*args, **kwargs):
+            self._calls.append((attr_name, args, kwargs))
+
+        if callable(getattr(self._client._wrapped_cls, attr_name)):
+            return batched_call
         else:
+            return batched_call()
+
+
+class PendingRequest(object):
+    __slots__ = ('message', 'result', 'retries', 'expiry')
+
+    def __init__(self, message, retries, expiry):
+        self.message = message
+        self.result = AsyncResult()
+        self.retries = retries
+        self.expiry = expiry
+
+
+class AsyncClient(Client):
+    """Pipelined client: remote calls return a gevent AsyncResult at once.
+
+    Requests are tagged with an ID and sent over a DEALER socket, so any
+    number of calls can be in flight at the same time. Each request is
+    resent on its own after client_timeout, up to client_retries times,
+    before its result is failed with a TimeoutException.
+    """
+
+    def __init__(self, broker, cls, service_suffix='', context=None):
+        self._pending = {}
+        # Every attempt uses the same timeout, so appending keeps this
+        # ordered by expiry
+        self._expiries = deque()
+        self._send_lock = Semaphore()
+
+        super(AsyncClient, self).__init__(
+            broker, cls, service_suffix, context
+        )
+
+        self._recv_greenlet = gevent.spawn(self._recv_loop)
+
+    def close(self):
+        self._recv_greenlet.kill()
+
+        for request in self._pending.values():
+            request.result.set_exception(TimeoutException())
+        self._pending.clear()
+        self._expiries.clear()
+
+        self._sock.close()
+
+    def _connect_to_broker(self):
+        log.info('Connecting to broker', broker=self._broker)
+
+        self._sock = self._context.socket(zmq.DEALER)
+        self._sock.linger = 0
+        self._sock.connect(self._broker)
+
+    def _send(self, message, service=None):
+        if not isinstance(message, list):
+            message = [message]
+
+        if service is None:
+            service = self._service
+
+        request_id = self._next_request_id()
+
+        trace = self._tracer.start()
+
+        message = [
+            b'', CLIENT, service, request_id, self._ttl, trace
+        ] + message
+
+        request = PendingRequest(
+            message, self._retries, time() + 1e-3 * self._timeout
+        )
+        self._pending[request_id] = request
+        self._expiries.append((request.expiry, request_id))
+
+        self._send_message(message)
+
+        return request.result
+
+    def _send_message(self, message):
+        if log.isEnabledFor(DEBUG):
+            log.debug('Sending to broker', message=message)
+
+        with self._send_lock:
+            self._sock.send_multipart(message, copy=False)
+
+    def _remote_call(self, attr_name, args, kwargs):
+        if log.isEnabledFor(DEBUG):
+            log.debug(
+                'Calling remote procedure',
+                cls=self._service,
+                attr=attr_name,
+                args=args,
+                kwargs=kwargs
+            )
+
+        return self._send(self._encode_call(attr_name, args, kwargs))
+
+    def _store_cached(self, key, result, ttl):
+        # Callers share the pending result, it is dropped again if it fails
+        super(AsyncClient, self)._store_cached(key, result, ttl)
+
+        result.rawlink(
+            lambda result: result.successful() or self._cache.discard(key)
+        )
+
+    def _control(self, command, args=None):
+        result = self._send(
+            self._encode_control(command, args), self._control_service
+        )
+
+        try:
+            return result.get()
+        except TimeoutException:
             return None
+
+    def batch(self, calls=None):
+        if calls is None:
+            return Batch(self)
+
+        calls = list(calls)
+
+        if log.isEnabledFor(DEBUG):
+            log.debug(
+                'Calling remote batch', cls=self._service, calls=len(calls)
+            )
+
+        # Every chunk is in flight at once, the returned greenlet joins
+        # them back into one flat list of results
+        chunks = [
+            self._send(self._encode_batch(calls[i:i + self._batch_size]))
+            for i in range(0, len(calls), self._batch_size)
+        ]
+
+        return gevent.spawn(
+            lambda: [result for chunk in chunks for result in chunk.get()]
+        )
+
+    def _recv_loop(self):
+        while True:
+            timeout = self._timeout
+            if self._expiries:
+                timeout = max(0, 1e3 * (self._expiries[0][0] - time()))
+
+            # Calls are sent from the callers' greenlets. A send can consume
+            # the edge on the socket's FD that a blocked Poller.poll is
+            # waiting for, a green recv is woken by it
+            message = None
+
+            with gevent.Timeout(1e-3 * timeout, False):
+                message = recv_multipart(self._sock)
+
+            if message is not None:
+                self._handle_reply(message)
+
+                while True:
+                    try:
+                        message = recv_multipart(self._sock, zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+
+                    self._handle_reply(message)
+
+            self._expire_requests()
+
+    def _handle_reply(self, message):
+        if log.isEnabledFor(DEBUG):
+            log.debug('Received reply', message=message)
+
+        assert len(message) >= 7
+
+        empty = message.pop(0)
+        assert empty == b''
+
+        header = message.pop(0)
+        assert header == CLIENT
+
+        service = message.pop(0)
+        assert self._ignore_service or service in (
+            self._service, self._control_service
+        )
+
+        request_id = message.pop(0)
+        request = self._pending.pop(request_id, None)
+
+        if request is None:
+            if log.isEnabledFor(DEBUG):
+                log.debug('Dropping late reply', request_id=request_id)
+            return
+
+        trace = message.pop(0)
+        if trace:
+            self._tracer.finish(
+                trace, self._span_name(service, request.message[6:])
+            )
+
+        try:
+            resp = self._decode_reply(message)
+        except Exception as exc:
+            request.result.set_exception(exc)
+            return
+
+        if isinstance(resp, Exception):
+            request.result.set_exception(resp)
+        else:
+            request.result.set(resp)
+
+    def _expire_requests(self):
+        now = time()
+
+        while self._expiries and self._expiries[0][0] <= now:
+            expiry, request_id = self._expiries.popleft()
+            request = self._pending.get(request_id)
+
+            # Already answered, or superseded by a later attempt
+            if request is None or request.expiry != expiry:
+                continue
+
+            request.retries -= 1
+
+            if request.retries > 0:
+                log.warn('No reply, resending', request_id=request_id)
+
+                request.expiry = now + 1e-3 * self._timeout
+                self._expiries.append((request.expiry, request_id))
+                self._send_message(request.message)
+            else:
+                log.error('No reply. No retries left. Abandoning')
+
+                self._pending.pop(request_id)
+                request.result.set_exception(TimeoutException())
+
+
+class ServiceClient(Client):
+    def __new__(cls, broker, context=None):
+        return object.__new__(cls)
+
+    def __init__(self, broker, context=None):
+        super(ServiceClient, self).__init__(
+            broker, type('None'), context=context
+        )
+
+        self._service = self._control_service
+        self._ignore_service = True
+
+    def stats(self):
+        return self._control(STATS)
+
+    def worker_stats(self, worker):
+        return self._control(WORKER_STATS, worker)
+
+    def methods(self, service):
+        return self._control(METHODS, service)
+
+    def metrics(self):
+        """Returns the broker's metrics in Prometheus text format"""
+        return self._control(METRICS)
+
+    def start_profile(self, worker, interval=None):
+        """Starts sampling the worker's stacks every interval ms"""
+        args = [worker, b'start']
+        if interval is not None:
+            args.append(str(interval).encode())
+
+        return self._control(PROFILE, args)
+
+    def stop_profile(self, worker):
+        """Stops the worker's profile and returns its collapsed stacks,
+        sample count and per-method timings
+        """
+        return self._control(PROFILE, [worker, b'stop'])
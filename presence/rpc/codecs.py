@@ -0,0 +1,197 @@
+import pickle
+import struct
+from collections import OrderedDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .. import config
+
+MSGPACK = b'msgpack'
+PICKLE = b'pickle'
+
+# msgpack extension types: anything it cannot represent natively, e.g.
+# exceptions raised by remote calls, is pickled into PICKLED_EXT and large
+# buffers are replaced by a BUFFER_EXT holding their frame index
+PICKLED_EXT = 1
+BUFFER_EXT = 2
+
+BUFFER_TYPES = (bytes, bytearray, memoryview)
+
+PickleBuffer = getattr(pickle, 'PickleBuffer', None)
+
+
+def _map_buffers(obj, func, depth=2):
+    # Replaces the buffers in obj with func(buffer). Only looks a couple
+    # of levels down, which covers call arguments and lists of results
+    # without walking whole batches
+    cls = type(obj)
+
+    if cls in BUFFER_TYPES:
+        return func(obj)
+    elif depth and (cls is tuple or cls is list):
+        items = [_map_buffers(item, func, depth - 1) for item in obj]
+
+        if any(a is not b for a, b in zip(items, obj)):
+            return cls(items)
+    elif depth and cls is dict:
+        items = {k: _map_buffers(v, func, depth - 1) for k, v in obj.items()}
+
+        if any(items[k] is not v for k, v in obj.items()):
+            return items
+
+    return obj
+
+
+def _out_of_band(obj, threshold):
+    # Wraps buffers of at least threshold bytes in a PickleBuffer so that
+    # the codecs send them as separate frames
+    def wrap(buffer):
+        if memoryview(buffer).nbytes >= threshold:
+            return PickleBuffer(buffer)
+
+        return buffer
+
+    return _map_buffers(obj, wrap)
+
+
+def _memoryview(buffer):
+    return buffer if type(buffer) is memoryview else memoryview(buffer)
+
+
+def _bytes(buffer):
+    return buffer if type(buffer) is bytes else bytes(buffer)
+
+
+def as_memoryviews(obj):
+    """Returns obj with its buffers as memoryviews.
+
+    Buffers sent out of band are decoded as memoryviews and the rest as
+    they were sent, this gives them one type whatever their size.
+    """
+    return _map_buffers(obj, _memoryview)
+
+
+def as_bytes(obj):
+    """Returns obj with its buffers as bytes, copying any memoryviews"""
+    return _map_buffers(obj, _bytes)
+
+
+class PickleCodec(object):
+    """Encodes to a pickle frame followed by any out-of-band buffers"""
+    name = PICKLE
+
+    def __init__(self, protocol=min(5, pickle.HIGHEST_PROTOCOL)):
+        self.protocol = protocol
+
+    def encode(self, obj):
+        if PickleBuffer is None or self.protocol < 5:
+            return [pickle.dumps(obj, protocol=self.protocol)]
+
+        buffers = []
+        payload = pickle.dumps(
+            _out_of_band(obj, config['zero_copy_threshold']),
+            protocol=self.protocol,
+            buffer_callback=buffers.append
+        )
+
+        return [payload] + [buffer.raw() for buffer in buffers]
+
+    def decode(self, frames):
+        if len(frames) == 1:
+            return pickle.loads(frames[0])
+
+        return pickle.loads(
+            frames[0], buffers=[memoryview(frame) for frame in frames[1:]]
+        )
+
+
+class MsgpackCodec(object):
+    """Encodes to a msgpack frame followed by any out-of-band buffers.
+
+    Opt in by listing it in the codecs setting. Values do not round trip
+    as they do with pickle: tuples come back as lists and dicts with
+    tuple keys cannot be decoded.
+    """
+    name = MSGPACK
+
+    def __init__(self, protocol=min(5, pickle.HIGHEST_PROTOCOL)):
+        self.protocol = protocol
+
+    def encode(self, obj):
+        buffers = []
+
+        if PickleBuffer is not None:
+            obj = _out_of_band(obj, config['zero_copy_threshold'])
+
+        payload = msgpack.packb(
+            obj,
+            default=lambda o: self._default(o, buffers),
+            use_bin_type=True
+        )
+
+        return [payload] + buffers
+
+    def decode(self, frames):
+        buffers = frames[1:]
+
+        return msgpack.unpackb(
+            frames[0],
+            ext_hook=lambda code, data: self._ext_hook(code, data, buffers),
+            raw=False,
+            strict_map_key=False
+        )
+
+    def _default(self, obj, buffers):
+        if PickleBuffer is not None and isinstance(obj, PickleBuffer):
+            index = len(buffers)
+            buffers.append(obj.raw())
+
+            return msgpack.ExtType(BUFFER_EXT, struct.pack('!I', index))
+
+        return msgpack.ExtType(
+            PICKLED_EXT, pickle.dumps(obj, protocol=self.protocol)
+        )
+
+    def _ext_hook(self, code, data, buffers):
+        if code == PICKLED_EXT:
+            return pickle.loads(data)
+        elif code == BUFFER_EXT:
+            (index, ) = struct.unpack('!I', data)
+
+            return memoryview(buffers[index])
+
+        return msgpack.ExtType(code, data)
+
+
+codecs = OrderedDict()
+codecs[PICKLE] = PickleCodec()
+if msgpack is not None:
+    codecs[MSGPACK] = MsgpackCodec()
+
+
+def get_codec(name):
+    """Returns the named codec, or pickle if it is not available here"""
+    return codecs.get(name, codecs[PICKLE])
+
+
+def available_codecs():
+    """Returns the names of the configured codecs available here, most
+    preferred first. Pickle is always available as the last resort.
+    """
+    names = [name for name in config['codecs'] if name in codecs]
+
+    if PICKLE not in names:
+        names.append(PICKLE)
+
+    return names
+
+
+def choose_codec(preferred, supported):
+    for name in preferred:
+        if name in supported:
+            return name
+
+    return PICKLE
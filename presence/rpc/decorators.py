@@ -0,0 +1,55 @@
+def _metadata(func):
+    try:
+        return func.__rpc__
+    except AttributeError:
+        func.__rpc__ = {}
+        return func.__rpc__
+
+
+def get_metadata(attr):
+    """Returns the RPC metadata set on a method or property by the
+    decorators in this module
+    """
+    if isinstance(attr, property):
+        attr = attr.fget
+
+    return getattr(attr, '__rpc__', {})
+
+
+def cacheable(ttl):
+    """Lets clients reuse the result of a method or property for ttl
+    seconds rather than asking a worker each time. Results are cached per
+    client and per arguments, calls with unhashable arguments always go
+    to the worker.
+
+    For a property, apply it to the getter beneath @property.
+    """
+
+    def decorate(func):
+        _metadata(func)['cacheable'] = ttl
+        return func
+
+    return decorate
+
+
+def expose(batchable=True, idempotent=False, timeout=None):
+    """Marks a method, or property getter, as served by workers. Once any
+    attribute of a class is exposed only exposed attributes are served.
+
+    batchable: whether the call may be made as part of a batch
+    idempotent: whether running it twice is harmless, its replies are then
+        not kept for retries
+    timeout: seconds after which a running call is abandoned and answered
+        with a TimeoutException. Threaded calls are left to finish
+    """
+
+    def decorate(func):
+        _metadata(func).update(
+            exposed=True,
+            batchable=batchable,
+            idempotent=idempotent,
+            timeout=timeout
+        )
+        return func
+
+    return decorate
@@ -0,0 +1,52 @@
+import gevent
+import structlog
+import zmq.green as zmq
+
+from .broker import Broker
+from .client import AsyncClient, Client, ServiceClient
+from .worker import Worker
+
+log = structlog.getLogger()
+
+
+class Embedded(object):
+    """A broker and its workers running as greenlets in this process.
+
+    Everything shares one zmq context, so local clients reach the broker
+    over inproc without a network hop. The broker may also bind further
+    endpoints, e.g. tcp or ipc, for clients and workers elsewhere, and
+    publish its events on events.
+    """
+
+    def __init__(self, endpoint='inproc://presence', binds=(), events=None):
+        self.endpoint = endpoint
+        self.context = zmq.Context()
+
+        self._broker = Broker(
+            [endpoint] + list(binds), context=self.context, events=events
+        )
+        self._greenlets = [gevent.spawn(self._broker.start)]
+
+    def add_worker(self, instance, **kwargs):
+        worker = Worker(self.endpoint, instance, context=self.context, **kwargs)
+        self._greenlets.append(gevent.spawn(worker.start))
+
+        return worker
+
+    def client(self, cls, **kwargs):
+        return Client(self.endpoint, cls, context=self.context, **kwargs)
+
+    def async_client(self, cls, **kwargs):
+        return AsyncClient(self.endpoint, cls, context=self.context, **kwargs)
+
+    def service_client(self):
+        return ServiceClient(self.endpoint, context=self.context)
+
+    def join(self):
+        gevent.joinall(self._greenlets)
+
+    def stop(self):
+        gevent.killall(self._greenlets)
+        self._greenlets = []
+
+        self.context.destroy(linger=0)
@@ -0,0 +1,70 @@
+import structlog
+import zmq.green as zmq
+
+from .codecs import available_codecs, get_codec
+from .utils import recv_multipart
+
+log = structlog.getLogger()
+
+WORKER_JOINED = b'worker.joined'
+WORKER_LEFT = b'worker.left'
+QUEUE_DEPTH = b'queue.depth'
+BROKER_METRICS = b'metrics'
+
+
+class Publisher(object):
+    """Publishes broker events on a PUB socket.
+
+    Each event is [topic, codec name, payload...]. With no subscribers
+    zmq drops them straight away, so publishing costs little more than
+    the encoding.
+    """
+
+    def __init__(self, context, bind):
+        self._codec = get_codec(available_codecs()[0])
+
+        self._sock = context.socket(zmq.PUB)
+        self._sock.linger = 0
+
+        if not isinstance(bind, list):
+            bind = [bind]
+
+        for endpoint in bind:
+            self._sock.bind(endpoint)
+
+            log.info('Publishing events', bind=endpoint)
+
+    def publish(self, topic, data):
+        self._sock.send_multipart(
+            [topic, self._codec.name] + self._codec.encode(data), copy=False
+        )
+
+
+class Subscriber(object):
+    """Receives events from a broker's Publisher, optionally only those
+    whose topic starts with one of topics
+    """
+
+    def __init__(self, endpoint, topics=(), context=None):
+        self._context = context or zmq.Context()
+
+        self._sock = self._context.socket(zmq.SUB)
+        self._sock.linger = 0
+        self._sock.connect(endpoint)
+
+        for topic in topics or (b'', ):
+            self._sock.setsockopt(zmq.SUBSCRIBE, topic)
+
+    def __iter__(self):
+        while True:
+            yield self.recv()
+
+    def recv(self):
+        """Returns the next (topic, data) pair"""
+        message = recv_multipart(self._sock)
+        topic, codec_name = message[:2]
+
+        return topic, get_codec(codec_name).decode(message[2:])
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,237 @@
+from math import frexp
+
+
+class Histogram(object):
+    """Latency histogram with fixed log-linear buckets.
+
+    Each doubling of the value above `lowest` seconds is split into
+    `precision` equal buckets, so a percentile is within 1/precision of
+    the true value, recording is O(1) and the memory used is fixed.
+    Histograms with the same layout can be merged, e.g. from several
+    processes.
+    """
+
+    def __init__(self, lowest=1e-6, doublings=28, precision=16):
+        self._lowest = lowest
+        self._doublings = doublings
+        self._precision = precision
+        self._counts = [0] * (doublings * precision + 1)
+
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self._counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        assert len(self._counts) == len(other._counts)
+
+        for index, count in enumerate(other._counts):
+            self._counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the percentile"""
+        if not self.count:
+            return 0.0
+
+        target = percent / 100.0 * self.count
+        seen = 0
+
+        for index, count in enumerate(self._counts):
+            seen += count
+
+            if seen >= target and count:
+                return min(self._upper(index), self.max)
+
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+            'max': self.max,
+        }
+
+    def as_dict(self):
+        return {
+            'lowest': self._lowest,
+            'doublings': self._doublings,
+            'precision': self._precision,
+            'counts': self._counts,
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['lowest'], data['doublings'], data['precision'])
+        histogram._counts = list(data['counts'])
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.max = data['max']
+
+        return histogram
+
+    def _index(self, value):
+        if value < self._lowest:
+            return 0
+
+        # value / lowest = mantissa * 2 ** exponent, 0.5 <= mantissa < 1
+        mantissa, exponent = frexp(value / self._lowest)
+        index = (exponent - 1) * self._precision + int(
+            (2 * mantissa - 1) * self._precision
+        ) + 1
+
+        return min(index, len(self._counts) - 1)
+
+    def _upper(self, index):
+        if index == 0:
+            return self._lowest
+
+        exponent, step = divmod(index - 1, self._precision)
+
+        return self._lowest * 2**exponent * (1 + (step + 1) / self._precision)
+
+
+class ServiceMetrics(object):
+    """Counters and latency histograms the broker keeps for one service.
+
+    Everything is preallocated, recording a request only bumps counters
+    and histogram buckets. The request rate is worked out from the
+    counters on a timer rather than per message.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.replies = 0
+        self.expired = 0
+        self.rejected = 0
+        self.rate = 0.0
+
+        # Seconds from arriving at the broker to being sent to a worker,
+        # from being sent to the reply arriving, and the two together
+        self.queue_wait = Histogram()
+        self.service_time = Histogram()
+        self.latency = Histogram()
+
+        self._last_requests = 0
+
+    def update_rate(self, interval):
+        self.rate = (self.requests - self._last_requests) / interval
+        self._last_requests = self.requests
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'replies': self.replies,
+            'expired': self.expired,
+            'rejected': self.rejected,
+            'rate': self.rate,
+            'queue_wait': self.queue_wait.summary(),
+            'service_time': self.service_time.summary(),
+            'latency': self.latency.summary(),
+        }
+
+
+def _labels(**labels):
+    return ','.join(
+        '{}="{}"'.format(name, value) for name, value in sorted(labels.items())
+    )
+
+
+def prometheus_text(services, workers):
+    """Renders metrics in the Prometheus text exposition format.
+
+    services maps a service name to a (ServiceMetrics, queue depth) pair
+    and workers maps (service, worker identity) to requests dispatched.
+    """
+    lines = []
+
+    def add(name, kind, help, samples):
+        lines.append('# HELP presence_{} {}'.format(name, help))
+        lines.append('# TYPE presence_{} {}'.format(name, kind))
+
+        for suffix, labels, value in samples:
+            lines.append(
+                'presence_{}{}{{{}}} {}'.format(name, suffix, labels, value)
+            )
+
+    counters = (
+        ('requests_total', 'requests', 'Requests accepted'),
+        ('replies_total', 'replies', 'Replies from workers'),
+        ('expired_total', 'expired', 'Requests dropped past their deadline'),
+        ('rejected_total', 'rejected', 'Requests refused by a full queue'),
+    )
+
+    for name, attr, help in counters:
+        add(
+            name, 'counter', help, [
+                ('', _labels(service=service), getattr(metrics, attr))
+                for service, (metrics, _) in sorted(services.items())
+            ]
+        )
+
+    add(
+        'request_rate', 'gauge', 'Requests per second', [
+            ('', _labels(service=service), metrics.rate)
+            for service, (metrics, _) in sorted(services.items())
+        ]
+    )
+    add(
+        'queue_depth', 'gauge', 'Requests waiting for a worker', [
+            ('', _labels(service=service), depth)
+            for service, (_, depth) in sorted(services.items())
+        ]
+    )
+
+    histograms = (
+        ('queue_wait_seconds', 'queue_wait', 'Time queued at the broker'),
+        ('service_seconds', 'service_time', 'Time from dispatch to reply'),
+        ('latency_seconds', 'latency', 'Time from arrival to reply'),
+    )
+
+    for name, attr, help in histograms:
+        samples = []
+
+        for service, (metrics, _) in sorted(services.items()):
+            histogram = getattr(metrics, attr)
+
+            for quantile in (0.5, 0.99, 0.999):
+                samples.append((
+                    '',
+                    _labels(service=service, quantile=quantile),
+                    histogram.percentile(100 * quantile)
+                ))
+
+            samples.append(('_sum', _labels(service=service), histogram.total))
+            samples.append(
+                ('_count', _labels(service=service), histogram.count)
+            )
+
+        add(name, 'summary', help, samples)
+
+    add(
+        'worker_requests_total', 'counter', 'Requests sent to each worker', [
+            ('', _labels(service=service, worker=worker), count)
+            for (service, worker), count in sorted(workers.items())
+        ]
+    )
+
+    return '\n'.join(lines) + '\n'
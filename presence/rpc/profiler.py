@@ -0,0 +1,84 @@
+import sys
+import threading
+from collections import Counter
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every other thread from a thread of its own.
+
+    Greenlets all run on the thread that runs the gevent loop, so each
+    sample is of whichever greenlet holds it, or the hub when idle. The
+    loop is never interrupted, the cost to it is the GIL handoffs.
+
+    The result is in the collapsed stack format, one line per distinct
+    stack of `frame;frame;... count` with the outermost frame first,
+    which flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval=0.005):
+        self._interval = interval
+        self._stacks = Counter()
+        self._labels = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        assert self._thread is None
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='presence-profiler', daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling and returns the collapsed stacks"""
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+        return self.collapsed()
+
+    def collapsed(self):
+        return ''.join(
+            '{} {}\n'.format(';'.join(stack), count)
+            for stack, count in self._stacks.most_common()
+        )
+
+    def _run(self):
+        ident = threading.get_ident()
+
+        while not self._stopped.wait(self._interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != ident:
+                    self._stacks[self._stack(frame)] += 1
+                    self.samples += 1
+
+    def _stack(self, frame):
+        stack = []
+
+        while frame is not None:
+            stack.append(self._label(frame.f_code, frame.f_globals))
+            frame = frame.f_back
+
+        stack.reverse()
+
+        return tuple(stack)
+
+    def _label(self, code, f_globals):
+        label = self._labels.get(code)
+
+        if label is None:
+            label = '{}:{}'.format(
+                f_globals.get('__name__', code.co_filename), code.co_name
+            )
+            self._labels[code] = label
+
+        return label
@@ -0,0 +1,116 @@
+from .decorators import get_metadata
+
+
+class Method(object):
+    __slots__ = (
+        'name', 'func', 'callable', 'batchable', 'idempotent', 'timeout',
+        'cacheable', 'calls', 'errors', 'time', 'max_time'
+    )
+
+    def __init__(self, name, func, metadata):
+        self.name = name
+        # Bound method for callables, None for attributes which are read
+        # from the instance on each call
+        self.func = func
+        self.callable = func is not None
+        self.batchable = metadata.get('batchable', True)
+        self.idempotent = metadata.get('idempotent', False)
+        self.timeout = metadata.get('timeout')
+        self.cacheable = metadata.get('cacheable')
+
+        # Calls served and the seconds they took
+        self.calls = 0
+        self.errors = 0
+        self.time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, failed=False):
+        self.calls += 1
+        self.time += elapsed
+
+        if failed:
+            self.errors += 1
+
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+
+    def timings(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'time': self.time,
+            'mean_time': self.time / self.calls if self.calls else 0.0,
+            'max_time': self.max_time,
+        }
+
+    def as_dict(self):
+        return {
+            'callable': self.callable,
+            'batchable': self.batchable,
+            'idempotent': self.idempotent,
+            'timeout': self.timeout,
+            'cacheable': self.cacheable,
+        }
+
+
+class Registry(object):
+    """The attributes of an instance that a worker serves.
+
+    Built once when the worker starts. If any attribute of the class is
+    marked with @expose only those are served, otherwise every public one
+    is. Methods are bound up front so a call is a single dict lookup.
+    """
+
+    def __init__(self, instance):
+        self._instance = instance
+        self._methods = {}
+
+        cls = instance.__class__
+        names = [name for name in dir(instance) if not name.startswith('_')]
+
+        # Look attributes up on the class first so that properties are
+        # not evaluated here
+        attrs = {}
+        for name in names:
+            attr = getattr(cls, name, None)
+            if attr is None:
+                attr = getattr(instance, name)
+            attrs[name] = attr
+
+        explicit = any(
+            get_metadata(attr).get('exposed') for attr in attrs.values()
+        )
+
+        for name, attr in attrs.items():
+            metadata = get_metadata(attr)
+
+            if explicit and not metadata.get('exposed'):
+                continue
+
+            func = getattr(instance, name) if callable(attr) else None
+            self._methods[name] = Method(name, func, metadata)
+
+    def __len__(self):
+        return len(self._methods)
+
+    def __contains__(self, name):
+        return name in self._methods
+
+    def get(self, name):
+        return self._methods.get(name)
+
+    def read(self, method):
+        return getattr(self._instance, method.name)
+
+    def timings(self):
+        """Call counts and times of the methods that have been called"""
+        return {
+            name: method.timings()
+            for name, method in self._methods.items() if method.calls
+        }
+
+    def describe(self):
+        return {
+            name: method.as_dict()
+            for name, method in self._methods.items()
+        }
@@ -0,0 +1,89 @@
+from heapq import heapify, heappop, heappush
+from math import ceil
+from time import time
+
+
+class Timer(object):
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class Scheduler(object):
+    """Timers for an event loop built around a zmq poll.
+
+    Timers are kept in a heap, so running them costs only those that are
+    due and the poll can sleep exactly until the next one. Cancelled timers
+    are dropped lazily, or compacted away once they make up half the heap.
+    Times are in seconds, as returned by time.time().
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cancelled = 0
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        heappush(self._heap, timer)
+
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer is None or timer.cancelled:
+            return
+
+        timer.cancelled = True
+        self._cancelled += 1
+
+        if self._cancelled > len(self._heap) // 2:
+            self._heap = [t for t in self._heap if not t.cancelled]
+            heapify(self._heap)
+            self._cancelled = 0
+
+    def run(self, now=None):
+        """Runs every timer due by now"""
+        if now is None:
+            now = time()
+
+        # Callbacks may add timers or compact the heap, so it is looked up
+        # afresh each time
+        while self._heap and self._heap[0].when <= now:
+            timer = heappop(self._heap)
+
+            if timer.cancelled:
+                self._cancelled -= 1
+                continue
+
+            # Mark it spent so a late cancel is a no-op
+            timer.cancelled = True
+            timer.callback(*timer.args)
+
+    def timeout(self, default=None, now=None):
+        """Returns the milliseconds until the next timer is due, suitable
+        for zmq poll, or default if there are no timers
+        """
+        heap = self._heap
+        while heap and heap[0].cancelled:
+            heappop(heap)
+            self._cancelled -= 1
+
+        if not heap:
+            return default
+
+        if now is None:
+            now = time()
+
+        return max(0, int(ceil(1e3 * (heap[0].when - now))))
@@ -0,0 +1,130 @@
+import atexit
+import json
+import os
+import struct
+from random import random
+from time import time
+
+# A sampled request carries a trace frame holding its trace ID and when
+# the client sent it. The broker appends when it queued and dispatched the
+# request, the worker when it started and finished, and the frame comes
+# back to the client with the reply. Unsampled requests carry b''
+TRACE = struct.Struct('!8sd')
+HOP = struct.Struct('!dd')
+SPAN = struct.Struct('!8sddddd')
+
+# Chrome trace event process IDs, one row group for each hop
+CLIENT_PID = 1
+BROKER_PID = 2
+WORKER_PID = 3
+
+# Trace files by path, shared by every tracer in the process
+_files = {}
+
+
+def _open(path):
+    f = _files.get(path)
+
+    if f is None:
+        f = open(path, 'w')
+
+        # The JSON array format may be left unterminated, so events can
+        # be appended as they come and the file is readable at any point
+        f.write('[\n')
+
+        for pid, name in (
+            (CLIENT_PID, 'client'),
+            (BROKER_PID, 'broker'),
+            (WORKER_PID, 'worker'),
+        ):
+            f.write(
+                json.dumps(
+                    {
+                        'name': 'process_name',
+                        'ph': 'M',
+                        'pid': pid,
+                        'args': {
+                            'name': name
+                        },
+                    }
+                ) + ',\n'
+            )
+
+        _files[path] = f
+
+    return f
+
+
+def _close_files():
+    for f in _files.values():
+        f.close()
+
+    _files.clear()
+
+
+atexit.register(_close_files)
+
+
+class Tracer(object):
+    """Samples requests for tracing and writes their spans to path.
+
+    Spans are written in the Chrome trace event format, which
+    chrome://tracing and Perfetto open. Every request is shown on its own
+    row, from the client sending it to the reply arriving, with the time
+    it spent queued at the broker and running in the worker beneath it.
+    The hops are timed by their own clocks, so across hosts the spans are
+    only as accurate as the clocks agree.
+    """
+
+    def __init__(self, sample_rate, path):
+        self._sample_rate = sample_rate
+        self._path = path
+
+    def start(self):
+        """Returns the trace frame for a new request"""
+        if self._sample_rate <= 0 or random() >= self._sample_rate:
+            return b''
+
+        return TRACE.pack(os.urandom(8), time())
+
+    def finish(self, frame, name):
+        """Writes the spans of a request once its reply has arrived"""
+        # Unsampled, or answered by the broker rather than a worker
+        if len(frame) != SPAN.size:
+            return
+
+        received = time()
+        trace_id, sent, enqueued, dispatched, started, finished = SPAN.unpack(
+            frame
+        )
+
+        trace_id = trace_id.hex()
+        tid = int(trace_id[:8], 16)
+
+        spans = (
+            (CLIENT_PID, name, sent, received),
+            (BROKER_PID, 'queued', enqueued, dispatched),
+            (WORKER_PID, 'running', started, finished),
+        )
+
+        f = _open(self._path)
+
+        for pid, span_name, start, end in spans:
+            f.write(
+                json.dumps(
+                    {
+                        'name': span_name,
+                        'cat': 'rpc',
+                        'ph': 'X',
+                        'ts': int(1e6 * start),
+                        'dur': max(0, int(1e6 * (end - start))),
+                        'pid': pid,
+                        'tid': tid,
+                        'args': {
+                            'trace_id': trace_id
+                        },
+                    }
+                ) + ',\n'
+            )
+
+        f.flush()
@@ -1,7 +1,14 @@
 import os
+import struct
 
 import psutil
 
+from .. import config
+
+# Resident memory, cpu seconds, requests served and requests in flight, as
+# sent by workers with their heartbeats
+USAGE = struct.Struct('!QdQI')
+
 
 def get_usage():
     pid = os.getpid()
@@ -23,3 +30,43 @@ def get_usage():
             'percent': cpu_percent,
         }
     }
+
+
+def pack_usage(served, in_flight):
+    process = psutil.Process(os.getpid())
+
+    with process.oneshot():
+        mem = process.memory_info()
+        cpu = process.cpu_times()
+
+    return USAGE.pack(mem.rss, cpu.user + cpu.system, served, in_flight)
+
+
+def unpack_usage(frame):
+    rss, cpu, served, in_flight = USAGE.unpack(frame)
+
+    return {
+        'memory': {
+            'resident': rss,
+        },
+        'cpu': {
+            'time': cpu,
+        },
+        'requests': served,
+        'in_flight': in_flight,
+    }
+
+
+def recv_multipart(sock, flags=0):
+    """Receives a message without copying large frames.
+
+    Frames below zero_copy_threshold are returned as bytes so they can be
+    compared and hashed as usual. Larger ones stay as zmq.Frame, which can
+    be forwarded as is or read through a memoryview.
+    """
+    threshold = config['zero_copy_threshold']
+
+    return [
+        frame.bytes if len(frame) < threshold else frame
+        for frame in sock.recv_multipart(flags, copy=False)
+    ]
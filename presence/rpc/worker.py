@@ -1,52 +1,305 @@
-import pickle
-from time import sleep, time
+from logging import DEBUG
+from time import perf_counter, time
 
 import structlog
 import zmq.green as zmq
+from gevent import Timeout
+from gevent.lock import Semaphore
+from gevent.pool import Pool
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
 
 from .. import config
-from . import DISCONNECT, HEARTBEAT, READY, REPLY, REQUEST, STATS, WORKER
-from .utils import get_usage
+from . import BATCH, CALL, DISCONNECT, HEARTBEAT, PROFILE, READY, REPLY, REQUEST, STATS, WORKER, CodecException, RPCException, TimeoutException
+from .cache import TTLCache
+from .codecs import PICKLE, as_memoryviews, available_codecs, codecs, get_codec
+from .profiler import SamplingProfiler
+from .registry import Registry
+from .scheduler import Scheduler
+from .tracing import HOP
+from .utils import get_usage, pack_usage, recv_multipart
 
 log = structlog.getLogger()
 
 
 class Worker(object):
-    def __init__(self, broker, instance, service_suffix=''):
+    """Serves the exposed methods of instance to clients of the broker.
+
+    bytes, bytearray and memoryview arguments are passed to methods as
+    memoryviews whatever their size, as large ones are received without
+    copying. Call bytes() on one for a copy. Buffers a method returns
+    reach the client as bytes.
+    """
+
+    def __init__(
+        self,
+        broker,
+        instance,
+        service_suffix='',
+        concurrency=1,
+        threaded=False,
+        prefetch=None,
+        context=None
+    ):
         self._broker = broker
         self._instance = instance
         self._service = bytes('{}{}'.format(instance.__class__.__name__, service_suffix), 'utf8')
+        self._registry = Registry(instance)
 
         self._heartbeat_liveness = config['heartbeat_liveness']
         self._heartbeat_interval = config['heartbeat_interval']
         self._reconnect_interval = config['reconnect_interval']
         self._timeout = config['worker_timeout']
 
-        self._liveness = 0
-        self._heartbeat_at = 0
-        self._expect_reply = False
-        self._reply_to = None
+        # The broker is presumed gone once nothing has been heard from it
+        # for heartbeat_liveness timeouts
+        self._liveness_window = 1e-3 * self._heartbeat_liveness * self._timeout
+        self._last_recv = 0
+        # Likewise anything we send stands in for a heartbeat
+        self._last_send = 0
+        self._heartbeats_suppressed = 0
+
+        # Reported to the broker with a heartbeat every usage_interval, so
+        # that stats can be read without asking each worker
+        self._usage_interval = 1e-3 * config['usage_interval']
+        self._served = 0
+        self._running = 0
+
+        # Started and stopped on demand through the control service
+        self._profiler = None
+
+        self._scheduler = Scheduler()
+        self._liveness_timer = None
+        self._reconnect_timer = None
+
+        # Up to concurrency requests run at once, each in its own greenlet.
+        # When threaded, the calls themselves are handed to a thread pool
+        # so that blocking code does not stall the event loop
+        self._concurrency = concurrency
+
+        # Classes whose state is also used by greenlets of their own, or
+        # that block on gevent primitives, say so with thread_safe = False
+        if threaded and not getattr(instance, 'thread_safe', True):
+            raise ValueError(
+                '{} cannot be run in a thread pool'.format(
+                    instance.__class__.__name__
+                )
+            )
 
-        self._context = zmq.Context()
-        self._poller = zmq.Poller()
+        self._pool = Pool(concurrency)
+        self._threadpool = ThreadPool(concurrency) if threaded else None
+        self._send_lock = Semaphore()
+
+        # The broker is granted one credit per request we are willing to
+        # hold. Prefetched requests wait in the queue so that a runner can
+        # start on the next one as soon as it replies
+        if prefetch is None:
+            prefetch = config['worker_prefetch']
+        self._credits = concurrency + prefetch
+        self._requests = Queue()
+        self._generation = 0
+
+        # Clients resend a request under the same ID when it is slow. The
+        # encoded reply is kept for a while so a retry is answered without
+        # running the call again, and a retry that arrives while the call
+        # is still running waits on it in _inflight
+        self._replies = TTLCache(
+            config['reply_cache_size'], 1e-3 * config['reply_cache_ttl']
+        )
+        self._inflight = {}
+        self._deduplicated = 0
+
+        self._context = context or zmq.Context()
         self._sock = None
 
     def start(self):
         self._connect_to_broker()
+        self._scheduler.call_later(
+            1e-3 * self._heartbeat_interval, self._send_heartbeat
+        )
+        self._scheduler.call_later(self._usage_interval, self._send_usage)
+
+        for _ in range(self._concurrency):
+            self._pool.spawn(self._run_requests)
+
+        # Runners are stopped as well when this greenlet is killed, e.g.
+        # by Embedded.stop
+        try:
+            while True:
+                request = self._recv()
+
+                if request is None:
+                    break
 
-        reply = None
+                self._requests.put((self._generation, ) + request)
+        finally:
+            self._pool.kill()
+
+            if self._profiler is not None:
+                self._profiler.stop()
+
+    def _run_requests(self):
         while True:
-            message = self._recv(reply)
+            request = self._requests.get()
 
-            if message is None:
-                break
+            # A runner that died would keep its credit from the broker for
+            # good, with concurrency 1 leaving a worker that only heartbeats
+            try:
+                self._handle_request(*request)
+            except Exception:
+                log.exception('Request failed')
+                self._fail_request(*request)
+
+    def _fail_request(
+        self, generation, reply_to, deadline, stamp, trace, message
+    ):
+        request_id = message[0] if message else b''
+
+        # Pickle, which every client understands, as the request's own
+        # codec may be what failed
+        frames = [PICKLE] + codecs[PICKLE].encode(
+            RPCException('Worker failed to handle the request')
+        )
+        started = time()
+
+        for waiter in self._inflight.pop(request_id, []):
+            self._send_reply(*waiter, request_id, frames, started)
+
+        self._send_reply(
+            generation, reply_to, stamp, trace, request_id, frames, started
+        )
+
+    def _handle_request(
+        self, generation, reply_to, deadline, stamp, trace, message
+    ):
+        assert len(message) >= 4
+        request_id, kind, codec_name = message[:3]
+        message = message[3:]
+
+        started = time()
+
+        frames = self._replies.get(request_id)
+
+        if frames is not None:
+            if log.isEnabledFor(DEBUG):
+                log.debug('Replying from cache', request_id=request_id)
+        elif request_id in self._inflight:
+            self._deduplicated += 1
+            self._inflight[request_id].append(
+                (generation, reply_to, stamp, trace)
+            )
+            return
+        elif deadline < time():
+            # The client has already given up, the reply only returns
+            # credit and is not cached so that a later retry still runs
+            if log.isEnabledFor(DEBUG):
+                log.debug(
+                    'Skipping expired request', request_id=request_id
+                )
+
+            codec = get_codec(codec_name)
+            frames = [codec.name] + codec.encode(
+                TimeoutException('Request expired before it started')
+            )
+        else:
+            self._inflight[request_id] = []
 
-            assert len(message) == 1
-            message = message[0]
+            codec = get_codec(codec_name)
 
-            reply = None
+            method = None
+            if kind == CALL:
+                method = self._registry.get(message[1].decode())
 
-            (cls_name, attr_name, args, kwargs) = pickle.loads(message)
+            timeout = None
+            if method is not None:
+                timeout = method.timeout
+
+            self._running += 1
+
+            try:
+                if codec_name not in codecs:
+                    reply = CodecException(
+                        'Unsupported codec {}'.format(codec_name)
+                    )
+                else:
+                    # Arguments that fail to decode are the caller's error
+                    with Timeout(timeout, TimeoutException):
+                        if self._threadpool is not None:
+                            reply = self._threadpool.apply(
+                                self._execute, (kind, codec, message)
+                            )
+                        else:
+                            reply = self._execute(kind, codec, message)
+            except Exception as exc:
+                reply = exc
+            finally:
+                self._running -= 1
+
+            self._served += 1
+
+            if log.isEnabledFor(DEBUG):
+                log.debug('Replying', reply=reply)
+
+            try:
+                frames = [codec.name] + codec.encode(reply)
+            except Exception as exc:
+                frames = [codec.name] + codec.encode(
+                    TypeError('Cannot encode reply: {!r}'.format(exc))
+                )
+
+            # Idempotent calls are simply run again when retried
+            if method is None or not method.idempotent:
+                self._replies.put(request_id, frames)
+
+            for waiter in self._inflight.pop(request_id):
+                self._send_reply(*waiter, request_id, frames, started)
+
+        self._send_reply(
+            generation, reply_to, stamp, trace, request_id, frames, started
+        )
+
+    def _send_reply(
+        self, generation, reply_to, stamp, trace, request_id, frames, started
+    ):
+        # Credit granted to an earlier connection is not returned
+        credits = b'1' if generation == self._generation else b'0'
+
+        # Sampled requests are given when the call started and finished
+        if trace:
+            trace += HOP.pack(started, time())
+
+        self._send_to_broker(
+            REPLY,
+            credits,
+            message=[stamp, reply_to, b'', request_id, trace] + frames
+        )
+
+    def _execute(self, kind, codec, message):
+        if kind == CALL:
+            cls_name, attr_name = message[:2]
+            (args, kwargs) = as_memoryviews(codec.decode(message[2:]))
+            reply = self._call(cls_name, attr_name.decode(), args, kwargs)
+        elif kind == BATCH:
+            cls_name = message[0]
+            calls = codec.decode(message[1:])
+            if log.isEnabledFor(DEBUG):
+                log.debug(
+                    'Batch received', cls_name=cls_name, calls=len(calls)
+                )
+
+            reply = []
+            for (attr_name, args, kwargs) in calls:
+                (args, kwargs) = as_memoryviews((args, kwargs))
+                reply.append(
+                    self._call(cls_name, attr_name, args, kwargs, batched=True)
+                )
+        else:
+            reply = ValueError('Unknown request kind {}'.format(kind))
+
+        return reply
+
+    def _call(self, cls_name, attr_name, args, kwargs, batched=False):
+        if log.isEnabledFor(DEBUG):
             log.debug(
                 'Call received',
                 cls_name=cls_name,
@@ -55,46 +308,76 @@ class Worker(object):
                 kwargs=kwargs
             )
 
-            if not cls_name == self._service:
-                reply = NameError(
-                    'Attempt to call remote function on instance of \'{}\' as \'{}\''.
-                    format(self._service, cls_name)
-                )
+        if not cls_name == self._service:
+            return NameError(
+                'Attempt to call remote function on instance of \'{}\' as \'{}\''.
+                format(self._service, cls_name)
+            )
 
-            if not hasattr(self._instance, attr_name):
-                reply = AttributeError(
-                    'Remote {} instance has no attribute \'{}\''.
-                    format(cls_name, attr_name)
-                )
+        method = self._registry.get(attr_name)
+
+        if method is None:
+            return AttributeError(
+                'Remote {} instance has no attribute \'{}\''.
+                format(cls_name, attr_name)
+            )
+
+        if batched and not method.batchable:
+            return ValueError(
+                'Remote {} method \'{}\' cannot be batched'.
+                format(cls_name, attr_name)
+            )
 
-            attr = getattr(self._instance, attr_name)
+        start = perf_counter()
+        failed = False
 
-            if callable(attr):
-                try:
-                    reply = attr(*args, **kwargs)
-                except Exception as exc:
-                    reply = exc
+        try:
+            if method.callable:
+                reply = method.func(*args, **kwargs)
             else:
-                reply = attr
+                reply = self._registry.read(method)
+        except Exception as exc:
+            reply = exc
+            failed = True
 
-            log.debug('Replying', reply=reply)
+        method.record(perf_counter() - start, failed)
 
-            reply = pickle.dumps(reply)
+        return reply
 
     def _connect_to_broker(self):
         log.info('Connecting to broker', broker=self._broker)
 
         if self._sock:
             log.info('Old socket expired. Creating new one.')
-            self._poller.unregister(self._sock)
             self._sock.close()
 
+        # Requests not yet started belong to the old connection, their
+        # clients will retry
+        self._generation += 1
+        while not self._requests.empty():
+            self._requests.get_nowait()
+
         self._sock = self._context.socket(zmq.DEALER)
         self._sock.linger = 0
         self._sock.connect(self._broker)
-        self._poller.register(self._sock, zmq.POLLIN)
 
-        self._send_to_broker(READY, self._service)
+        self._scheduler.cancel(self._reconnect_timer)
+        self._reconnect_timer = None
+
+        self._last_recv = time()
+        self._scheduler.cancel(self._liveness_timer)
+        self._liveness_timer = self._scheduler.call_at(
+            self._last_recv + self._liveness_window, self._check_liveness
+        )
+
+        self._send_to_broker(
+            READY,
+            self._service,
+            message=[
+                str(self._credits).encode(),
+                b','.join(available_codecs())
+            ] + codecs[PICKLE].encode(self._registry.describe())
+        )
 
     def _send_to_broker(self, command, option=None, message=[]):
         if not isinstance(message, list):
@@ -105,37 +388,72 @@ class Worker(object):
 
         message = [b'', WORKER, command] + message
 
-        log.debug('Sending message to broker', message=message)
+        if log.isEnabledFor(DEBUG):
+            log.debug('Sending message to broker', message=message)
+
+        # Replies are sent from many greenlets, keep their frames together
+        with self._send_lock:
+            self._sock.send_multipart(message, copy=False)
+            self._last_send = time()
 
-        self._sock.send_multipart(message)
+    def _send_heartbeat(self):
+        when = self._last_send + 1e-3 * self._heartbeat_interval
 
-    def _recv(self, reply=None):
-        assert reply is not None or not self._expect_reply
+        if time() >= when:
+            self._send_to_broker(HEARTBEAT)
+            when = self._last_send + 1e-3 * self._heartbeat_interval
+        else:
+            self._heartbeats_suppressed += 1
 
-        if reply is not None:
-            if not isinstance(reply, list):
-                reply = [reply]
+        self._scheduler.call_at(when, self._send_heartbeat)
 
-            assert self._reply_to is not None
+    def _send_usage(self):
+        # Sent even when traffic makes plain heartbeats unnecessary
+        in_flight = self._running + self._requests.qsize()
+        self._send_to_broker(
+            HEARTBEAT, message=[pack_usage(self._served, in_flight)]
+        )
 
-            reply = [self._reply_to, b''] + reply
+        self._scheduler.call_later(self._usage_interval, self._send_usage)
 
-            self._send_to_broker(REPLY, message=reply)
+    def _check_liveness(self):
+        expiry = self._last_recv + self._liveness_window
 
-        self._expect_reply = True
+        if expiry > time():
+            self._liveness_timer = self._scheduler.call_at(
+                expiry, self._check_liveness
+            )
+        else:
+            log.warn('Disconnected from broker')
+
+            self._liveness_timer = None
+            self._reconnect_timer = self._scheduler.call_later(
+                1e-3 * self._reconnect_interval, self._connect_to_broker
+            )
 
+    def _recv(self):
         while True:
+            # Timers run at the top of the loop, requests return from it
+            self._scheduler.run()
+
+            # Runners send replies on this socket from other greenlets. A
+            # send can consume the edge on the socket's FD that a blocked
+            # Poller.poll is waiting for, a green recv is woken by it
+            message = None
+            timeout = 1e-3 * self._scheduler.timeout(self._timeout)
+
             try:
-                items = self._poller.poll(self._timeout)
+                with Timeout(timeout, False):
+                    message = recv_multipart(self._sock)
             except KeyboardInterrupt:
                 break
 
-            if items:
-                message = self._sock.recv_multipart()
+            if message is not None:
 
-                log.debug('Message received', message=message)
+                if log.isEnabledFor(DEBUG):
+                    log.debug('Message received', message=message)
 
-                self._liveness = self._heartbeat_liveness
+                self._last_recv = time()
 
                 assert len(message) >= 3
 
@@ -147,45 +465,100 @@ class Worker(object):
 
                 command = message.pop(0)
                 if command == REQUEST:
-                    self._reply_to = message.pop(0)
+                    reply_to = message.pop(0)
 
                     empty = message.pop(0)
                     assert empty == b''
 
-                    return message
+                    # Time left is taken now, requests may wait in the
+                    # queue before a runner is free
+                    deadline = time() + 1e-3 * int(message.pop(1))
+
+                    # Broker timings and the trace frame, both returned with
+                    # the reply
+                    stamp = message.pop(1)
+                    trace = message.pop(1)
+
+                    return reply_to, deadline, stamp, trace, message
                 elif command == HEARTBEAT:
                     pass
                 elif command == STATS:
                     self._handle_stats(message)
+                elif command == PROFILE:
+                    self._handle_profile(message)
                 elif command == DISCONNECT:
                     self._connect_to_broker()
                 else:
                     log.error('Invalid message', message=message)
-            else:
-                self._liveness -= 1
 
-                if self._liveness == 0:
-                    log.warn('Disconnected from broker')
+        log.warn('Interrupted')
+        return None
 
-                    try:
-                        sleep(1e-3 * self._reconnect_interval)
-                    except KeyboardInterrupt:
-                        break
+    def _handle_stats(self, message):
+        assert len(message) == 4
 
-                    self._connect_to_broker()
+        client = message.pop(0)
 
-            if time() > self._heartbeat_at:
-                self._send_to_broker(HEARTBEAT)
-                self._heartbeat_at = time() + 1e-3 * self._heartbeat_interval
+        empty = message.pop(0)
+        assert empty == b''
 
-        log.warn('Interrupted')
-        return None
+        request_id = message.pop(0)
+        codec = get_codec(message.pop(0))
 
-    def _handle_stats(self, message):
-        assert len(message) == 1
+        reply = [b'', client, b'', request_id, b'', codec.name]
+        usage = get_usage()
+        usage['heartbeats_suppressed'] = self._heartbeats_suppressed
+        usage['reply_cache'] = self._replies.stats()
+        usage['reply_cache']['deduplicated'] = self._deduplicated
+        usage['methods'] = self._registry.timings()
+
+        reply += codec.encode(usage)
+
+        self._send_to_broker(REPLY, b'0', message=reply)
+
+    def _handle_profile(self, message):
+        assert len(message) >= 5
 
         client = message.pop(0)
 
-        reply = [client, b'', pickle.dumps(get_usage())]
+        empty = message.pop(0)
+        assert empty == b''
+
+        request_id = message.pop(0)
+        codec = get_codec(message.pop(0))
+        action = message.pop(0)
+
+        if action == b'start':
+            if self._profiler is None:
+                interval = config['profile_interval']
+                if message:
+                    interval = float(message.pop(0))
+
+                self._profiler = SamplingProfiler(1e-3 * interval)
+                self._profiler.start()
+
+                log.info('Profiling started', interval=interval)
+
+            profile = True
+        elif action == b'stop':
+            profile = None
+
+            if self._profiler is not None:
+                # Stopped first, so the sample count matches the stacks
+                stacks = self._profiler.stop()
+
+                profile = {
+                    'samples': self._profiler.samples,
+                    'stacks': stacks,
+                    'methods': self._registry.timings(),
+                }
+                self._profiler = None
+
+                log.info('Profiling stopped', samples=profile['samples'])
+        else:
+            profile = ValueError('Unknown profile action {}'.format(action))
+
+        reply = [b'', client, b'', request_id, b'', codec.name]
+        reply += codec.encode(profile)
 
-        self._send_to_broker(REPLY, message=reply)
+        self._send_to_broker(REPLY, b'0', message=reply)
@@ -0,0 +1,302 @@
+import mmap
+import os
+import re
+import struct
+from time import time
+
+import gevent
+import structlog
+from gevent.event import Event
+from gevent.lock import Semaphore
+
+from presence import config
+
+log = structlog.getLogger()
+
+SNAPSHOT_MAGIC = b'PRSNAP1\n'
+SNAPSHOT_HEADER = struct.Struct('!8sQQ')
+
+UPDATE = 1
+REMOVE = 2
+
+# op, first_seen, last_seen, then the lengths of mac, ip and hostname.
+# A length of NONE stands for a missing ip or hostname
+RECORD = struct.Struct('!BddHHH')
+NONE = 0xffff
+
+LOG_NAME = re.compile(r'^wal\.(\d+)$')
+
+
+def _pack(op, mac, ip, hostname, first_seen, last_seen):
+    mac = mac.encode('utf8')
+    ip = ip.encode('utf8') if ip is not None else None
+    hostname = hostname.encode('utf8') if hostname is not None else None
+
+    header = RECORD.pack(
+        op, first_seen, last_seen, len(mac),
+        len(ip) if ip is not None else NONE,
+        len(hostname) if hostname is not None else NONE
+    )
+
+    return b''.join((header, mac, ip or b'', hostname or b''))
+
+
+def _unpack(buf, offset):
+    """Returns (op, mac, ip, hostname, first_seen, last_seen) and the offset
+    of the next record, or None if the buffer ends part way through
+    """
+    if offset + RECORD.size > len(buf):
+        return None, offset
+
+    (op, first_seen, last_seen, mac_len, ip_len,
+     hostname_len) = RECORD.unpack_from(buf, offset)
+    offset += RECORD.size
+
+    fields = []
+    for length in (mac_len, ip_len, hostname_len):
+        if length == NONE:
+            fields.append(None)
+            continue
+
+        if offset + length > len(buf):
+            return None, offset
+
+        fields.append(buf[offset:offset + length].decode('utf8'))
+        offset += length
+
+    mac, ip, hostname = fields
+
+    return (op, mac, ip, hostname, first_seen, last_seen), offset
+
+
+def _fsync(f):
+    # Run on the hub's thread pool so the event loop is not blocked
+    gevent.get_hub().threadpool.apply(os.fsync, (f.fileno(), ))
+
+
+class Journal(object):
+    """Durable storage for a LeaseTable.
+
+    Every change is appended to a write-ahead log. Appends are buffered and
+    written with a single fsync per commit interval (group commit), on a
+    thread so the event loop keeps running. Periodically the log is rotated
+    and a compact snapshot of the whole table is written, after which older
+    logs are deleted. Recovery memory-maps the snapshot and replays only the
+    logs written since it was taken.
+    """
+
+    def __init__(self, path, table):
+        self._path = path
+        self._table = table
+
+        self._commit_interval = config['store_commit_interval']
+        self._snapshot_interval = config['store_snapshot_interval']
+        self._snapshot_records = config['store_snapshot_records']
+        self._sync_commit = config['store_sync_commit']
+
+        self._generation = 0
+        self._file = None
+        self._buffer = bytearray()
+        self._records = 0
+        self._committed = Event()
+        self._lock = Semaphore()
+        self._greenlets = []
+
+        os.makedirs(path, exist_ok=True)
+
+    def open(self):
+        self._recover()
+        self._open_log(self._generation)
+
+        self._greenlets = [
+            gevent.spawn(self._run_commits),
+            gevent.spawn(self._run_snapshots),
+        ]
+
+    def close(self):
+        gevent.killall(self._greenlets)
+
+        self.commit()
+        self._file.close()
+
+    def log_update(self, mac, ip, hostname, seen):
+        self._append(_pack(UPDATE, mac, ip, hostname, seen, seen))
+
+    def log_remove(self, mac):
+        self._append(_pack(REMOVE, mac, None, None, 0, 0))
+
+    def commit(self):
+        with self._lock:
+            self._commit_locked()
+
+    def snapshot(self):
+        start = time()
+
+        # Everything up to here is in the snapshot, so new changes go to a
+        # new log which recovery will replay on top of it
+        with self._lock:
+            self._commit_locked()
+            self._file.close()
+            self._open_log(self._generation + 1)
+            self._records = 0
+
+            generation = self._generation
+            records = [
+                _pack(
+                    UPDATE, lease.mac, lease.ip, lease.hostname,
+                    lease.first_seen, lease.last_seen
+                ) for lease in self._table
+            ]
+
+        tmp = os.path.join(self._path, 'snapshot.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(
+                SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, generation, len(records))
+            )
+            f.write(b''.join(records))
+            f.flush()
+            _fsync(f)
+        os.rename(tmp, os.path.join(self._path, 'snapshot'))
+
+        for old, name in self._logs():
+            if old < generation:
+                os.unlink(os.path.join(self._path, name))
+
+        log.info(
+            'Snapshot written',
+            leases=len(records),
+            generation=generation,
+            time=(time() - start)
+        )
+
+    def _append(self, record):
+        self._buffer += record
+        self._records += 1
+
+        if self._sync_commit:
+            self._committed.wait()
+
+    def _commit_locked(self):
+        if not self._buffer:
+            return
+
+        buffer, self._buffer = self._buffer, bytearray()
+        committed, self._committed = self._committed, Event()
+
+        self._file.write(buffer)
+        _fsync(self._file)
+
+        committed.set()
+
+    def _run_commits(self):
+        while True:
+            gevent.sleep(1e-3 * self._commit_interval)
+            self.commit()
+
+    def _run_snapshots(self):
+        last = time()
+
+        while True:
+            gevent.sleep(1e-3 * self._commit_interval)
+
+            due = time() - last > 1e-3 * self._snapshot_interval
+            if self._records and (
+                due or self._records >= self._snapshot_records
+            ):
+                self.snapshot()
+                last = time()
+
+    def _open_log(self, generation):
+        self._generation = generation
+        self._file = open(
+            os.path.join(self._path, 'wal.{:08d}'.format(generation)),
+            'ab',
+            buffering=0
+        )
+
+    def _logs(self):
+        logs = []
+
+        for name in os.listdir(self._path):
+            match = LOG_NAME.match(name)
+
+            if match:
+                logs.append((int(match.group(1)), name))
+
+        return sorted(logs)
+
+    def _recover(self):
+        start = time()
+
+        generation = 0
+        leases = 0
+
+        path = os.path.join(self._path, 'snapshot')
+        if os.path.exists(path):
+            generation, leases = self._load_snapshot(path)
+
+        replayed = 0
+        for log_generation, name in self._logs():
+            if log_generation >= generation:
+                replayed += self._replay_log(os.path.join(self._path, name))
+                generation = log_generation
+
+        self._generation = generation
+
+        log.info(
+            'Store recovered',
+            snapshot=leases,
+            replayed=replayed,
+            leases=len(self._table),
+            time=(time() - start)
+        )
+
+    def _load_snapshot(self, path):
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                (magic, generation, count) = SNAPSHOT_HEADER.unpack_from(buf)
+                assert magic == SNAPSHOT_MAGIC
+
+                offset = SNAPSHOT_HEADER.size
+                for _ in range(count):
+                    record, offset = _unpack(buf, offset)
+                    assert record is not None
+
+                    (_, mac, ip, hostname, first_seen, last_seen) = record
+
+                    lease = self._table.update(mac, ip, hostname, last_seen)
+                    lease.first_seen = first_seen
+
+        return generation, count
+
+    def _replay_log(self, path):
+        replayed = 0
+
+        with open(path, 'rb') as f:
+            buf = f.read()
+
+        offset = 0
+        while offset < len(buf):
+            record, end = _unpack(buf, offset)
+
+            if record is None:
+                break
+
+            (op, mac, ip, hostname, _, last_seen) = record
+
+            if op == UPDATE:
+                self._table.update(mac, ip, hostname, last_seen)
+            elif op == REMOVE:
+                self._table.remove(mac)
+
+            offset = end
+            replayed += 1
+
+        # A crash part way through a write leaves a torn record at the end
+        if offset < len(buf):
+            log.warn('Truncating torn log record', path=path, offset=offset)
+
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+
+        return replayed
@@ -0,0 +1,162 @@
+from collections import OrderedDict
+
+
+class Lease(object):
+    __slots__ = ('mac', 'ip', 'hostname', 'first_seen', 'last_seen')
+
+    def __init__(self, mac, ip, hostname, seen):
+        self.mac = mac
+        self.ip = ip
+        self.hostname = hostname
+        self.first_seen = seen
+        self.last_seen = seen
+
+    def as_dict(self):
+        return {
+            'mac': self.mac,
+            'ip': self.ip,
+            'hostname': self.hostname,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+        }
+
+
+class LeaseTable(object):
+    """In-memory DHCP leases indexed by MAC, IP and hostname.
+
+    Leases are kept in an OrderedDict keyed by MAC and moved to the end
+    whenever they are seen, so the table is also ordered by last_seen.
+    Recent leases are found by walking back from the newest and expired
+    ones by walking forward from the oldest, both stopping at the first
+    lease outside the window. A sighting older than the newest lease is
+    put in its place by moving the newer ones behind it, so sightings out
+    of time order cost one step per newer lease. An older timestamp never
+    moves last_seen backwards.
+    """
+
+    def __init__(self):
+        self._by_mac = OrderedDict()
+        self._by_ip = {}
+        self._by_hostname = {}
+
+    def __len__(self):
+        return len(self._by_mac)
+
+    def __iter__(self):
+        return iter(self._by_mac.values())
+
+    def update(self, mac, ip, hostname, seen):
+        lease = self._by_mac.get(mac)
+
+        if lease is None:
+            lease = Lease(mac, None, None, seen)
+            self._by_mac[mac] = lease
+            self._place(lease)
+        elif seen >= lease.last_seen:
+            lease.last_seen = seen
+            self._by_mac.move_to_end(mac)
+            self._place(lease)
+
+        if lease.ip != ip:
+            self._unindex_ip(lease)
+            lease.ip = ip
+            self._index_ip(lease)
+
+        if lease.hostname != hostname:
+            self._unindex_hostname(lease)
+            lease.hostname = hostname
+            self._index_hostname(lease)
+
+        return lease
+
+    def remove(self, mac):
+        lease = self._by_mac.pop(mac, None)
+
+        if lease is not None:
+            self._unindex_ip(lease)
+            self._unindex_hostname(lease)
+
+        return lease
+
+    def get_by_mac(self, mac):
+        return self._by_mac.get(mac)
+
+    def get_by_ip(self, ip):
+        return self._by_ip.get(ip)
+
+    def get_by_hostname(self, hostname):
+        return list(self._by_hostname.get(hostname, {}).values())
+
+    def seen_since(self, cutoff):
+        """Yields leases seen at or after cutoff, newest first"""
+        for mac in reversed(self._by_mac):
+            lease = self._by_mac[mac]
+
+            if lease.last_seen < cutoff:
+                break
+
+            yield lease
+
+    def expire(self, cutoff):
+        """Removes and returns leases last seen before cutoff, oldest first"""
+        expired = []
+
+        while self._by_mac:
+            lease = next(iter(self._by_mac.values()))
+
+            if lease.last_seen >= cutoff:
+                break
+
+            expired.append(self.remove(lease.mac))
+
+        return expired
+
+    def _place(self, lease):
+        # The lease is at the end, leases seen after it are moved behind
+        # it to keep the table ordered by last_seen
+        newer = []
+
+        for mac in reversed(self._by_mac):
+            other = self._by_mac[mac]
+
+            if other is lease:
+                continue
+
+            if other.last_seen <= lease.last_seen:
+                break
+
+            newer.append(mac)
+
+        for mac in reversed(newer):
+            self._by_mac.move_to_end(mac)
+
+    def _index_ip(self, lease):
+        if lease.ip is None:
+            return
+
+        # The address has been handed to a new device, the old holder
+        # keeps its record but can no longer be found by it
+        previous = self._by_ip.get(lease.ip)
+        if previous is not None and previous is not lease:
+            previous.ip = None
+
+        self._by_ip[lease.ip] = lease
+
+    def _unindex_ip(self, lease):
+        if self._by_ip.get(lease.ip) is lease:
+            del self._by_ip[lease.ip]
+
+    def _index_hostname(self, lease):
+        if lease.hostname is None:
+            return
+
+        self._by_hostname.setdefault(lease.hostname, {})[lease.mac] = lease
+
+    def _unindex_hostname(self, lease):
+        leases = self._by_hostname.get(lease.hostname)
+
+        if leases is not None:
+            leases.pop(lease.mac, None)
+
+            if not leases:
+                del self._by_hostname[lease.hostname]
@@ -1,8 +1,99 @@
+from time import time
+
+import gevent
 import structlog
 
+from presence import config
+from presence.tasks.journal import Journal
+from presence.tasks.leases import LeaseTable
+from presence.tasks.tracker import PresenceTracker
+
 log = structlog.getLogger()
 
 
+def _as_dict(lease):
+    return lease.as_dict() if lease is not None else None
+
+
 class Store(object):
-    def add_dhcp(self, mac, ip, hostname):
+    # The leases, presence wheel and journal are shared with the presence
+    # and commit greenlets, and waits for a commit are on gevent events, so
+    # methods must run on the event loop rather than in a thread pool
+    thread_safe = False
+
+    def __init__(self, path=None):
+        self._leases = LeaseTable()
+        self._journal = None
+
+        if path is not None:
+            self._journal = Journal(path, self._leases)
+            self._journal.open()
+
+        self._presence_tick = 1e-3 * config['presence_tick']
+        self._presence = PresenceTracker(
+            1e-3 * config['departure_timeout'], self._presence_tick, time()
+        )
+
+        for lease in self._leases:
+            self._presence.seen(lease.mac, lease.last_seen, restore=True)
+
+        self._presence_greenlet = gevent.spawn(self._run_presence)
+
+    def add_dhcp(self, mac, ip, hostname, seen=None):
+        if seen is None:
+            seen = time()
+
+        mac = mac.lower()
+
+        self._leases.update(mac, ip, hostname, seen)
+
+        if self._journal is not None:
+            self._journal.log_update(mac, ip, hostname, seen)
+
+        self._presence.seen(mac, seen)
+
         return True
+
+    def lookup_mac(self, mac):
+        return _as_dict(self._leases.get_by_mac(mac.lower()))
+
+    def lookup_ip(self, ip):
+        return _as_dict(self._leases.get_by_ip(ip))
+
+    def lookup_hostname(self, hostname):
+        leases = self._leases.get_by_hostname(hostname)
+
+        return [lease.as_dict() for lease in leases]
+
+    def recently_seen(self, seconds):
+        cutoff = time() - seconds
+
+        return [lease.as_dict() for lease in self._leases.seen_since(cutoff)]
+
+    def expire(self, seconds):
+        cutoff = time() - seconds
+
+        expired = self._leases.expire(cutoff)
+
+        if self._journal is not None:
+            for lease in expired:
+                self._journal.log_remove(lease.mac)
+
+        if expired:
+            log.info('Expired leases', count=len(expired))
+
+        return len(expired)
+
+    def count(self):
+        return len(self._leases)
+
+    def presence(self, mac):
+        return _as_dict(self._presence.get(mac.lower()))
+
+    def present(self):
+        return [device.as_dict() for device in self._presence.present()]
+
+    def _run_presence(self):
+        while True:
+            gevent.sleep(self._presence_tick)
+            self._presence.tick(time())
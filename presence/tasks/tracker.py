@@ -0,0 +1,140 @@
+from logging import DEBUG
+
+import structlog
+
+from presence.wheel import TimerWheel
+
+log = structlog.getLogger()
+
+ARRIVED = 'arrived'
+PRESENT = 'present'
+DEPARTED = 'departed'
+
+
+class Device(object):
+    __slots__ = ('mac', 'state', 'last_seen', 'changed', 'timer')
+
+    def __init__(self, mac, state, seen):
+        self.mac = mac
+        self.state = state
+        self.last_seen = seen
+        self.changed = seen
+        self.timer = None
+
+    def as_dict(self):
+        return {
+            'mac': self.mac,
+            'state': self.state,
+            'last_seen': self.last_seen,
+            'changed': self.changed,
+        }
+
+
+class PresenceTracker(object):
+    """Tracks whether each device is on the network.
+
+    A device is ARRIVED when first seen (or seen again after leaving),
+    PRESENT on any later sighting and DEPARTED once it has not been seen
+    for departure_timeout seconds. Each device has one timer on a timing
+    wheel. Sightings only update last_seen; when the timer fires a device
+    that was seen in the meantime is simply re-armed, so a tick only costs
+    the timers falling due in it. Departed devices are kept for another
+    departure_timeout, so they can still be looked up, and then dropped.
+
+    Arrivals and departures are logged per device at debug and counted
+    at info once per tick.
+    """
+
+    def __init__(self, departure_timeout, tick, now):
+        self._timeout = departure_timeout
+        self._wheel = TimerWheel(tick, now)
+        self._devices = {}
+        self._arrivals = 0
+
+    def __len__(self):
+        return len(self._devices)
+
+    def get(self, mac):
+        return self._devices.get(mac)
+
+    def present(self):
+        return [
+            device for device in self._devices.values()
+            if device.state != DEPARTED
+        ]
+
+    def seen(self, mac, now, restore=False):
+        """Records a sighting, returning the device if its state changed.
+
+        Restored devices, e.g. loaded from a snapshot, are marked PRESENT
+        without reporting an arrival.
+        """
+        device = self._devices.get(mac)
+
+        if device is None:
+            device = Device(mac, PRESENT if restore else ARRIVED, now)
+            self._devices[mac] = device
+            self._arm(device)
+
+            if restore:
+                return None
+        else:
+            device.last_seen = max(device.last_seen, now)
+
+            if device.state == PRESENT:
+                return None
+
+            device.state = ARRIVED if device.state == DEPARTED else PRESENT
+            device.changed = now
+            self._arm(device)
+
+        if device.state == ARRIVED:
+            self._arrivals += 1
+            if log.isEnabledFor(DEBUG):
+                log.debug('Device arrived', mac=mac)
+
+        return device
+
+    def tick(self, now):
+        """Advances to now, returning the devices that departed"""
+        departed = []
+
+        for device in self._wheel.advance(now):
+            device.timer = None
+
+            if device.state == DEPARTED:
+                # Not seen again since departing
+                del self._devices[device.mac]
+                continue
+
+            expiry = device.last_seen + self._timeout
+
+            if expiry > now:
+                self._arm(device)
+            else:
+                device.state = DEPARTED
+                device.changed = now
+                departed.append(device)
+
+                self._arm(device, now + self._timeout)
+
+                if log.isEnabledFor(DEBUG):
+                    log.debug('Device departed', mac=device.mac)
+
+        if self._arrivals or departed:
+            log.info(
+                'Presence changed',
+                arrived=self._arrivals,
+                departed=len(departed),
+                devices=len(self._devices)
+            )
+            self._arrivals = 0
+
+        return departed
+
+    def _arm(self, device, when=None):
+        if when is None:
+            when = device.last_seen + self._timeout
+
+        if device.timer is None:
+            device.timer = self._wheel.schedule(when, device)
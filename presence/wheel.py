@@ -0,0 +1,117 @@
+from math import ceil
+
+
+class Timer(object):
+    __slots__ = ('deadline', 'value', 'bucket')
+
+    def __init__(self, deadline, value):
+        self.deadline = deadline
+        self.value = value
+        self.bucket = None
+
+
+class TimerWheel(object):
+    """Hierarchical timing wheel.
+
+    Time is counted in ticks. Level 0 has one bucket per tick for the next
+    `slots` ticks, each higher level covers `slots` times the span of the one
+    below, and timers beyond the top level wait in an overflow set. Whenever
+    a lower level wraps around, the matching bucket of the level above is
+    cascaded down. Scheduling and cancelling are O(1) and advancing costs
+    the timers that expire plus the (amortised) cascades, independent of how
+    many timers are pending.
+    """
+
+    def __init__(self, tick, now, slots=64, levels=4):
+        assert slots & (slots - 1) == 0, 'slots must be a power of two'
+
+        self._tick = tick
+        self._slots = slots
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._levels = levels
+
+        self._now = int(now / tick)
+        self._wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self._overflow = set()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def tick(self):
+        return self._tick
+
+    def schedule(self, when, value):
+        """Schedules value to expire at time when, returning its Timer"""
+        deadline = max(int(ceil(when / self._tick)), self._now + 1)
+
+        timer = Timer(deadline, value)
+        self._place(timer)
+        self._count += 1
+
+        return timer
+
+    def cancel(self, timer):
+        if timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self._count -= 1
+
+    def advance(self, now):
+        """Moves the wheel on to time now, returning the values of every
+        timer that expired on the way, earliest first
+        """
+        target = int(now / self._tick)
+        expired = []
+
+        while self._now < target:
+            self._now += 1
+            self._cascade()
+
+            bucket = self._wheels[0][self._now & self._mask]
+
+            if bucket:
+                for timer in bucket:
+                    timer.bucket = None
+                    expired.append(timer.value)
+
+                self._count -= len(bucket)
+                bucket.clear()
+
+        return expired
+
+    def _place(self, timer):
+        delta = timer.deadline - self._now
+
+        for level in range(self._levels):
+            if delta < 1 << (self._bits * (level + 1)):
+                index = (timer.deadline >> (self._bits * level)) & self._mask
+                bucket = self._wheels[level][index]
+                break
+        else:
+            bucket = self._overflow
+
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def _cascade(self):
+        # Each time a level wraps, the bucket of the level above that
+        # covers the coming period is spread over the levels below it
+        for level in range(1, self._levels):
+            if (self._now >> (self._bits * (level - 1))) & self._mask:
+                return
+
+            index = (self._now >> (self._bits * level)) & self._mask
+            self._redistribute(self._wheels[level][index])
+
+        if not (self._now >> (self._bits * (self._levels - 1))) & self._mask:
+            self._redistribute(self._overflow)
+
+    def _redistribute(self, bucket):
+        timers = list(bucket)
+        bucket.clear()
+
+        for timer in timers:
+            self._place(timer)
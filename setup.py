@@ -43,6 +43,7 @@ setup(
         'psutil',
         'structlog[dev]',
     ),
+    extras_require={'msgpack': ('msgpack', )},
     tests_require=(),
     description=('Presence detects when a mobile device enters a home network'),
     long_description=read('README.rst'),
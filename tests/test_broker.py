@@ -0,0 +1,61 @@
+import logging
+from time import time
+
+import pytest
+
+import presence.log
+from presence.rpc import CALL, CLIENT, READY, REPLY
+from presence.rpc.broker import Broker
+from presence.rpc.codecs import PICKLE
+
+SERVICE = b'Service'
+WORKER = b'w'
+
+
+class NullBroker(Broker):
+    def _send_to_worker(self, worker, command, option=None, message=[]):
+        worker.last_sent = time()
+
+
+@pytest.fixture
+def broker():
+    presence.log.configure(logging.WARNING)
+
+    broker = NullBroker('inproc://test-broker')
+
+    # Room for one running and one prefetched request
+    broker._handle_worker(WORKER, [READY, SERVICE, b'2', PICKLE])
+
+    return broker
+
+
+def _request(broker):
+    broker._handle_client(
+        b'c', [SERVICE, b'r', b'2500', b'', CALL, PICKLE, b'']
+    )
+
+
+def _reply(broker):
+    broker._handle_worker(
+        WORKER, [REPLY, b'1', b'', b'c', b'', b'r', b'', PICKLE, b'']
+    )
+
+
+def _expire(broker):
+    worker = broker._workers[WORKER.hex().encode()]
+    worker.expiry = time() - 1
+
+    broker._expire_worker(worker)
+
+
+def test_busy_worker_with_credit_is_not_expired(broker):
+    _request(broker)
+
+    # Still waiting for another request, but stuck in the first
+    assert broker._waiting_workers
+    _expire(broker)
+    assert broker._workers
+
+    _reply(broker)
+    _expire(broker)
+    assert not broker._workers
@@ -0,0 +1,130 @@
+import logging
+
+import gevent
+import pytest
+
+import presence.log
+from presence import config
+from presence.rpc import AsyncClient, Client, Embedded, OverloadedException, expose
+
+
+class Service(object):
+    @expose()
+    def echo(self, value):
+        return value
+
+    @expose(batchable=False)
+    def single(self):
+        return True
+
+    def hidden(self):
+        return True
+
+
+@pytest.fixture
+def embedded():
+    presence.log.configure(logging.WARNING)
+
+    embedded = Embedded('inproc://test-client')
+    embedded.add_worker(Service())
+
+    yield embedded
+
+    embedded.stop()
+
+
+@pytest.mark.parametrize('client_cls', [Client, AsyncClient])
+def test_wrapped_class_as_keyword(embedded, client_cls):
+    client = client_cls(
+        embedded.endpoint, cls=Service, context=embedded.context
+    )
+
+    assert isinstance(client, client_cls)
+    assert callable(client.echo)
+
+
+def test_batch_errors_are_per_call(embedded):
+    client = embedded.client(Service)
+
+    def batch():
+        # Fetches the methods along with the codec
+        client.echo(0)
+
+        return client.batch([
+            ('echo', (1, ), {}),
+            ('hidden', (), {}),
+            ('single', (), {}),
+            ('echo', (2, ), {}),
+        ])
+
+    results = gevent.spawn(batch).get()
+
+    assert results[0] == 1
+    assert isinstance(results[1], AttributeError)
+    assert isinstance(results[2], ValueError)
+    assert results[3] == 2
+
+
+def test_methods_are_refreshed_on_a_miss(embedded):
+    client = embedded.client(Service)
+
+    def call():
+        client.echo(0)
+
+        # As if fetched long ago, before a worker serving echo was upgraded
+        del client._methods[b'echo']
+        client._methods_fetched = 0
+
+        return client.echo(1)
+
+    assert gevent.spawn(call).get() == 1
+
+
+def test_unexposed_methods_do_not_refetch(embedded, monkeypatch):
+    client = embedded.client(Service)
+    refreshes = []
+
+    def call():
+        client.echo(0)
+
+        refresh = client._refresh_methods
+        monkeypatch.setattr(
+            client, '_refresh_methods',
+            lambda: refreshes.append(1) or refresh()
+        )
+
+        for _ in range(5):
+            with pytest.raises(AttributeError):
+                client.hidden()
+
+        # Once the methods are old a miss fetches them, only the once
+        client._methods_fetched = 0
+
+        for _ in range(5):
+            with pytest.raises(AttributeError):
+                client.hidden()
+
+    gevent.spawn(call).get()
+
+    assert len(refreshes) == 1
+
+
+def test_batch_raises_request_errors(monkeypatch):
+    presence.log.configure(logging.WARNING)
+
+    # Every request is rejected by the broker
+    monkeypatch.setitem(config, 'service_max_queue', 0)
+
+    embedded = Embedded('inproc://test-client-rejected')
+    embedded.add_worker(Service())
+
+    try:
+        client = embedded.client(Service)
+
+        def batch():
+            return client.batch([('echo', (1, ), {})])
+
+        with pytest.raises(OverloadedException):
+            gevent.spawn(batch).get()
+    finally:
+        embedded.stop()
@@ -0,0 +1,87 @@
+import logging
+
+import gevent
+import pytest
+
+import presence.log
+from presence import config
+from presence.rpc import DISCONNECT, READY, CodecException, Embedded
+from presence.rpc.broker import Broker
+from presence.rpc.codecs import MSGPACK, PICKLE, codecs
+
+pytestmark = pytest.mark.skipif(
+    MSGPACK not in codecs, reason='msgpack is not installed'
+)
+
+SERVICE = b'Service'
+
+
+class Service(object):
+    def echo(self, value):
+        return value
+
+
+class NullBroker(Broker):
+    def _send_to_worker(self, worker, command, option=None, message=[]):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def prefer_msgpack(monkeypatch):
+    presence.log.configure(logging.WARNING)
+    monkeypatch.setitem(config, 'codecs', [MSGPACK, PICKLE])
+
+
+def test_service_codecs_follow_workers():
+    broker = NullBroker('inproc://test-codecs')
+    service = broker._get_service(SERVICE)
+
+    assert service.codecs is None
+
+    broker._handle_worker(b'a', [READY, SERVICE, b'1', b'msgpack,pickle'])
+    assert service.codecs == {MSGPACK, PICKLE}
+
+    broker._handle_worker(b'b', [READY, SERVICE, b'1', b'pickle'])
+    assert service.codecs == {PICKLE}
+
+    broker._handle_worker(b'b', [DISCONNECT])
+    assert service.codecs == {MSGPACK, PICKLE}
+
+    broker._handle_worker(b'a', [DISCONNECT])
+    assert service.codecs is None
+
+
+def test_codec_is_not_fixed_before_workers_join():
+    embedded = Embedded('inproc://test-negotiate')
+    client = embedded.client(Service)
+
+    try:
+        assert gevent.spawn(client._get_codec).get().name == PICKLE
+        assert client._codec is None
+
+        embedded.add_worker(Service())
+
+        def negotiated():
+            while client._codec is None:
+                client._get_codec()
+                gevent.sleep(0.01)
+
+            return client._codec.name
+
+        assert gevent.spawn(negotiated).get(timeout=5) == MSGPACK
+    finally:
+        embedded.stop()
+
+
+def test_rejected_codec_is_renegotiated():
+    embedded = Embedded('inproc://test-reject')
+    client = embedded.client(Service)
+    client._codec = codecs[MSGPACK]
+
+    try:
+        reply = [PICKLE] + codecs[PICKLE].encode(CodecException())
+
+        assert isinstance(client._decode_reply(reply), CodecException)
+        assert client._codec is None
+    finally:
+        embedded.stop()
@@ -0,0 +1,106 @@
+import logging
+import os
+
+import gevent
+import pytest
+
+import presence.log
+from presence.tasks.journal import Journal
+from presence.tasks.leases import LeaseTable
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    presence.log.configure(logging.WARNING)
+
+
+def _open(path):
+    table = LeaseTable()
+    journal = Journal(str(path), table)
+    journal.open()
+
+    return journal, table
+
+
+def _update(journal, table, mac, ip, seen):
+    table.update(mac, ip, None, seen)
+    journal.log_update(mac, ip, None, seen)
+
+
+def _crash(journal):
+    # Whatever was committed is on disk, nothing else is flushed
+    gevent.killall(journal._greenlets)
+    journal._file.close()
+
+
+def _logs(path):
+    return sorted(name for name in os.listdir(str(path)) if name != 'snapshot')
+
+
+def test_snapshot_and_tail_are_recovered(tmp_path):
+    journal, table = _open(tmp_path)
+    _update(journal, table, 'a', '10.0.0.1', 100)
+    _update(journal, table, 'b', '10.0.0.2', 200)
+    journal.snapshot()
+
+    _update(journal, table, 'a', '10.0.0.3', 300)
+    table.remove('b')
+    journal.log_remove('b')
+    _update(journal, table, 'c', '10.0.0.4', 400)
+    journal.commit()
+    _crash(journal)
+
+    journal, table = _open(tmp_path)
+
+    try:
+        assert [lease.mac for lease in table] == ['a', 'c']
+
+        lease = table.get_by_mac('a')
+        assert lease.ip == '10.0.0.3'
+        assert lease.first_seen == 100
+        assert lease.last_seen == 300
+    finally:
+        journal.close()
+
+
+def test_torn_record_is_truncated(tmp_path):
+    journal, table = _open(tmp_path)
+    _update(journal, table, 'a', '10.0.0.1', 100)
+    journal.commit()
+
+    path = journal._file.name
+    size = os.path.getsize(path)
+
+    # A crash part way through writing the next record
+    journal._file.write(b'\x01\x00\x00')
+    _crash(journal)
+
+    journal, table = _open(tmp_path)
+
+    try:
+        assert [lease.mac for lease in table] == ['a']
+        assert os.path.getsize(path) == size
+
+        # New records follow straight on from the last whole one
+        _update(journal, table, 'b', '10.0.0.2', 200)
+        journal.commit()
+        _crash(journal)
+
+        journal, table = _open(tmp_path)
+        assert [lease.mac for lease in table] == ['a', 'b']
+    finally:
+        journal.close()
+
+
+def test_snapshot_deletes_older_logs(tmp_path):
+    journal, table = _open(tmp_path)
+
+    try:
+        _update(journal, table, 'a', '10.0.0.1', 100)
+        journal.snapshot()
+        _update(journal, table, 'b', '10.0.0.2', 200)
+        journal.snapshot()
+
+        assert _logs(tmp_path) == ['wal.00000002']
+    finally:
+        journal.close()
@@ -0,0 +1,32 @@
+from presence.tasks.leases import LeaseTable
+
+
+def _table(*sightings):
+    table = LeaseTable()
+
+    for mac, seen in sightings:
+        table.update(mac, None, None, seen)
+
+    return table
+
+
+def test_out_of_order_sightings_stay_ordered():
+    table = _table(('a', 100), ('b', 200), ('c', 90))
+
+    assert [lease.mac for lease in table] == ['c', 'a', 'b']
+    assert [lease.mac for lease in table.seen_since(150)] == ['b']
+    assert [lease.mac for lease in table.expire(95)] == ['c']
+
+
+def test_older_sighting_does_not_move_lease():
+    table = _table(('a', 100), ('b', 200), ('a', 50))
+
+    assert table.get_by_mac('a').last_seen == 100
+    assert [lease.mac for lease in table] == ['a', 'b']
+
+
+def test_later_sighting_between_others():
+    table = _table(('a', 100), ('b', 200), ('c', 300), ('a', 250))
+
+    assert [lease.mac for lease in table] == ['b', 'a', 'c']
+    assert [lease.mac for lease in table.expire(260)] == ['b', 'a']
@@ -0,0 +1,105 @@
+"""Round trips through a broker and worker in their own processes.
+
+Catches replies that sit on a socket until a poll timeout fires rather
+than being received straight away, which shows up as calls taking over
+a second instead of a few milliseconds.
+"""
+import logging
+import multiprocessing
+import os
+import tempfile
+from time import perf_counter
+
+import pytest
+
+import presence.log
+from presence.rpc import AsyncClient, Broker, Client, ServiceClient, Worker
+
+CALLS = 200
+
+# A lost wakeup stalls a call for over a second, a healthy round trip
+# takes a few ms
+MAX_LATENCY = 0.5
+
+
+class Echo(object):
+    def echo(self, value):
+        return value
+
+
+def _run_broker(endpoint):
+    presence.log.configure(logging.WARNING)
+    Broker(endpoint).start()
+
+
+def _run_worker(endpoint, concurrency):
+    presence.log.configure(logging.WARNING)
+    Worker(endpoint, Echo(), concurrency=concurrency).start()
+
+
+@pytest.fixture(scope='module', params=[1, 4], ids=['serial', 'concurrent'])
+def endpoint(request):
+    presence.log.configure(logging.WARNING)
+
+    tmp_dir = tempfile.mkdtemp(prefix='presence-test-')
+    endpoint = 'ipc://{}'.format(os.path.join(tmp_dir, 'broker'))
+
+    mp = multiprocessing.get_context('fork')
+    processes = [
+        mp.Process(target=_run_broker, args=(endpoint, )),
+        mp.Process(target=_run_worker, args=(endpoint, request.param)),
+    ]
+
+    for process in processes:
+        process.start()
+
+    service_client = ServiceClient(endpoint)
+    while not (service_client.stats() or {}).get('waiting_workers'):
+        pass
+
+    yield endpoint
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+def test_sequential_calls(endpoint):
+    client = Client(endpoint, Echo)
+    client.echo(0)
+
+    latencies = []
+    for i in range(CALLS):
+        start = perf_counter()
+        assert client.echo(i) == i
+        latencies.append(perf_counter() - start)
+
+    assert max(latencies) < MAX_LATENCY
+
+
+def test_sequential_async_calls(endpoint):
+    client = AsyncClient(endpoint, Echo)
+    client.echo(0).get()
+
+    latencies = []
+    for i in range(CALLS):
+        start = perf_counter()
+        assert client.echo(i).get() == i
+        latencies.append(perf_counter() - start)
+
+    client.close()
+
+    assert max(latencies) < MAX_LATENCY
+
+
+def test_pipelined_async_calls(endpoint):
+    client = AsyncClient(endpoint, Echo)
+    client.echo(0).get()
+
+    start = perf_counter()
+    results = [client.echo(i) for i in range(CALLS)]
+    assert [result.get() for result in results] == list(range(CALLS))
+
+    client.close()
+
+    assert perf_counter() - start < MAX_LATENCY
@@ -0,0 +1,59 @@
+from presence.rpc.scheduler import Scheduler
+
+
+def test_timers_run_in_order_once_due():
+    scheduler = Scheduler()
+    ran = []
+
+    scheduler.call_at(20, ran.append, 'b')
+    scheduler.call_at(10, ran.append, 'a')
+    scheduler.call_at(30, ran.append, 'c')
+
+    scheduler.run(now=5)
+    assert ran == []
+    assert scheduler.timeout(now=5) == 5000
+
+    scheduler.run(now=20)
+    assert ran == ['a', 'b']
+    assert len(scheduler) == 1
+
+
+def test_cancelled_timers_do_not_run():
+    scheduler = Scheduler()
+    ran = []
+
+    timer = scheduler.call_at(10, ran.append, 'a')
+    scheduler.call_at(20, ran.append, 'b')
+    scheduler.cancel(timer)
+    scheduler.cancel(timer)
+
+    assert len(scheduler) == 1
+    assert scheduler.timeout(now=0) == 20000
+
+    scheduler.run(now=30)
+    assert ran == ['b']
+    assert scheduler.timeout('idle') == 'idle'
+
+
+def test_cancel_from_a_callback():
+    scheduler = Scheduler()
+    ran = []
+
+    # Cancelling most of the heap from a callback compacts it mid run
+    timers = [scheduler.call_at(20 + i, ran.append, i) for i in range(10)]
+    scheduler.call_at(30, ran.append, 'last')
+
+    def cancel_all():
+        ran.append('cancel')
+        for timer in timers:
+            scheduler.cancel(timer)
+
+        # Added during the run and already due
+        scheduler.call_at(5, ran.append, 'added')
+
+    scheduler.call_at(10, cancel_all)
+
+    scheduler.run(now=40)
+    assert ran == ['cancel', 'added', 'last']
+    assert len(scheduler) == 0
+    assert scheduler.timeout('idle') == 'idle'
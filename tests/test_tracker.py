@@ -0,0 +1,28 @@
+from presence.tasks.tracker import ARRIVED, DEPARTED, PresenceTracker
+
+
+def test_departed_devices_are_dropped():
+    tracker = PresenceTracker(10.0, 1.0, 0.0)
+    tracker.seen('a', 0.0)
+
+    assert [device.mac for device in tracker.tick(11.0)] == ['a']
+    assert tracker.get('a').state == DEPARTED
+
+    # Still known for another timeout, then forgotten
+    tracker.tick(15.0)
+    assert tracker.get('a') is not None
+
+    tracker.tick(22.0)
+    assert tracker.get('a') is None
+    assert len(tracker) == 0
+
+
+def test_device_seen_again_after_departing_is_kept():
+    tracker = PresenceTracker(10.0, 1.0, 0.0)
+    tracker.seen('a', 0.0)
+    tracker.tick(11.0)
+
+    assert tracker.seen('a', 15.0).state == ARRIVED
+
+    tracker.tick(22.0)
+    assert tracker.get('a').state == ARRIVED
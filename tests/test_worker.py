@@ -0,0 +1,152 @@
+import logging
+from time import time
+
+import gevent
+import pytest
+from gevent.event import Event
+
+import presence.log
+from presence.rpc import CALL, Embedded, Worker, expose
+from presence.rpc.codecs import PICKLE, codecs
+from presence.tasks.store import Store
+
+
+class Service(object):
+    def echo(self, value):
+        return value
+
+    def generate(self):
+        return (i for i in range(3))
+
+    def buffer_type(self, value):
+        return type(value).__name__
+
+    def blob(self, size):
+        return b'a' * size
+
+
+class Counter(object):
+    def __init__(self):
+        self.calls = 0
+        self.release = Event()
+        self.release.set()
+
+    @expose()
+    def count(self):
+        self.release.wait()
+        self.calls += 1
+
+        return self.calls
+
+    @expose(idempotent=True)
+    def peek(self):
+        self.calls += 1
+
+        return self.calls
+
+
+class RecordingWorker(Worker):
+    def __init__(self, instance):
+        super(RecordingWorker, self).__init__(
+            'inproc://test-replies', instance
+        )
+        self.sent = []
+
+    def _send_to_broker(self, command, option=None, message=[]):
+        self.sent.append((command, option, message))
+
+    def request(self, request_id, attr_name):
+        message = [request_id, CALL, PICKLE, b'Counter', attr_name]
+        message += codecs[PICKLE].encode(((), {}))
+
+        self._handle_request(
+            self._generation, b'client', time() + 10, b'', b'', message
+        )
+
+    def replies(self):
+        return [
+            codecs[PICKLE].decode(message[6:])
+            for (_, _, message) in self.sent
+        ]
+
+
+@pytest.fixture
+def embedded():
+    presence.log.configure(logging.WARNING)
+
+    embedded = Embedded('inproc://test-worker')
+    embedded.add_worker(Service(), concurrency=1)
+
+    yield embedded
+
+    embedded.stop()
+
+
+def _call(embedded, attr_name, *args):
+    client = embedded.client(Service)
+
+    def call():
+        return getattr(client, attr_name)(*args)
+
+    return gevent.spawn(call).get()
+
+
+def test_unencodable_reply_is_an_error(embedded):
+    with pytest.raises(TypeError):
+        _call(embedded, 'generate')
+
+    # The only runner survived and its credit was returned
+    assert _call(embedded, 'echo', 1) == 1
+
+
+@pytest.mark.parametrize('size', [10, 70000])
+def test_buffer_types_do_not_depend_on_size(embedded, size):
+    assert _call(embedded, 'buffer_type', b'a' * size) == 'memoryview'
+    assert type(_call(embedded, 'blob', size)) is bytes
+
+
+def test_store_is_not_run_threaded():
+    with pytest.raises(ValueError):
+        Worker('inproc://test-threaded', Store(), threaded=True)
+
+
+def test_retried_request_is_answered_from_cache():
+    worker = RecordingWorker(Counter())
+
+    worker.request(b'1', b'count')
+    worker.request(b'1', b'count')
+    worker.request(b'2', b'count')
+
+    assert worker.replies() == [1, 1, 2]
+    assert worker._replies.stats()['hits'] == 1
+
+    # Every reply returns its credit
+    assert [option for (_, option, _) in worker.sent] == [b'1'] * 3
+
+
+def test_retry_waits_for_the_running_call():
+    counter = Counter()
+    counter.release.clear()
+    worker = RecordingWorker(counter)
+
+    first = gevent.spawn(worker.request, b'1', b'count')
+    retry = gevent.spawn(worker.request, b'1', b'count')
+    gevent.sleep(0)
+
+    assert worker.sent == []
+
+    counter.release.set()
+    gevent.joinall([first, retry])
+
+    assert counter.calls == 1
+    assert worker.replies() == [1, 1]
+    assert worker._deduplicated == 1
+
+
+def test_idempotent_calls_are_not_cached():
+    worker = RecordingWorker(Counter())
+
+    worker.request(b'1', b'peek')
+    worker.request(b'1', b'peek')
+
+    assert worker.replies() == [1, 2]